@@ -0,0 +1,254 @@
+"""Checks that the optimized code paths give the same results as the straightforward ones::
+
+    python benchmarks/checks.py              #all checks
+    python benchmarks/checks.py block_sub    #only some of them
+
+* ``block_sub``: :meth:`ttyrec.io.Block.sub` over many entries against ``re.sub`` over their
+  joined payloads, for several payload sizes and patterns (including empty matches).
+* ``remove_window_size``: :func:`ttyrec.extra_effects.RemoveWindowSize` as batch effect with
+  several block sizes against one ``re.sub`` over the whole recording.
+* ``ascii_errors``: the error paths of :func:`ttyrec.io.iter_ascii` (strict and lenient),
+  including that a bad entry is reported without reading the rest of the input.
+* ``redraws``: the screen shown by :meth:`ttyrec.io.TTYrecStream.minimize_redraws` against
+  the one of the original recording at the time of every entry left.
+
+Exits with 1 if any check fails.
+"""
+import os
+import re
+import sys
+import time
+import traceback
+import logging
+from io import BytesIO
+from random import Random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ttyrec.io import TTYrecStream, TTYrecEntry, TTYrecWriter, Block, ASCIIParseError, BLOCK_SIZE, iter_ascii
+from ttyrec.extra_effects import RemoveWindowSize
+from ttyrec.vt import Screen
+
+import synthetic
+
+class CheckError(Exception):
+    pass
+
+def _expect(condition, message, *args):
+    if not condition:
+        raise CheckError(message % args)
+
+def _split(data, size):
+    return [data[start:start + size] for start in xrange(0, len(data), size)]
+
+def _random_text(r, size, alphabet='ab x\r\n\x07'):
+    return ''.join(r.choice(alphabet) for _ in xrange(size))
+
+def _ttyrec(entries):
+    """:param entries: list of (duration, payload).
+:returns: a :class:`ttyrec.io.TTYrecStream` reading them from memory."""
+    fout = BytesIO()
+    writer = TTYrecWriter(fout)
+    for duration, payload in entries:
+        writer.write(duration, payload)
+    writer.flush()
+    return TTYrecStream().load_ttyrec(BytesIO(fout.getvalue()))
+
+#(pattern, replacement, also checked from an offset other than 0)
+_SUBSTITUTIONS = [
+    ('\x07', '', True),
+    (r' \r(?!\n)', '', True),
+    ('ab', 'X', True),
+    (r'(a)(b)', r'\2\1', True),
+    ('\r\n', lambda m: '\n', True),
+    (r'a+b*', r'<\g<0>>', False),
+    ('x*', '-', False),
+    ('(?=a)', '^', False),
+    ('b|', '.', False),
+    ('$', 'END', False),
+]
+
+def check_block_sub():
+    r = Random(1)
+    data = _random_text(r, 5000)
+    for size in (1, 2, 3, 16, 1000, len(data)):
+        payloads = _split(data, size)
+        for pattern, repl, with_pos in _SUBSTITUTIONS:
+            block = Block([TTYrecEntry(0.01, payload) for payload in payloads])
+            block.sub(pattern, repl)
+            entries = block.split()
+            result = ''.join(entry.payload for entry in entries)
+            _expect(len(entries) == len(payloads), '%r: %s entries instead of %s', pattern, len(entries),
+                    len(payloads))
+            _expect(result == re.sub(pattern, repl, data), '%r with payloads of %s bytes differs from re.sub',
+                    pattern, size)
+            if not with_pos:
+                continue
+            pos = len(data) // 3
+            block = Block([TTYrecEntry(0.01, payload) for payload in payloads], pos=pos)
+            block.sub(pattern, repl)
+            result = ''.join(entry.payload for entry in block.split())
+            _expect(result == data[:pos] + re.sub(pattern, repl, data[pos:]),
+                    '%r with payloads of %s bytes differs from re.sub after offset %s', pattern, size, pos)
+    #a match within an entry only changes that entry
+    payloads = _split(data, 7)
+    block = Block([TTYrecEntry(0.01, payload) for payload in payloads])
+    block.sub('\x07', '')
+    changed = [entry.payload for entry in block.split()]
+    _expect(changed == [payload.replace('\x07', '') for payload in payloads], 'entries got the wrong part')
+
+def check_remove_window_size():
+    r = Random(2)
+    data = _random_text(r, 20000, 'ab \r\r\n')
+    expected = re.sub(r' \r(?!\n)', '', data)
+    for payload_size in (1, 2, 5, 64):
+        payloads = _split(data, payload_size)
+        for block_size in (1, 2, 7, 64, 4096, BLOCK_SIZE):
+            stream = _ttyrec([(0.01, payload) for payload in payloads])
+            result = ''.join(entry.payload for entry in stream.batch_effect(RemoveWindowSize, block_size=block_size))
+            _expect(result == expected, 'payloads of %s bytes in blocks of %s bytes differ from re.sub',
+                    payload_size, block_size)
+
+class _CountingReader(object):
+    """Binary stream counting the bytes read from it."""
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+        self.read_bytes = 0
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.read_bytes += len(data)
+        return data
+
+_ENTRY = '[0.01] 5\nhello\n'
+
+#(bad entry after the first one, error message)
+_BAD_ENTRIES = [
+    ('[0.01] 9\nhello\n', 'payload of 9 bytes is not followed by a newline'),
+    ('[x.y] 5\nhello\n', 'invalid header'),
+    ('[0.0.1] 5\nhello\n', 'invalid duration'),
+    ('hello\n', 'invalid header'),
+]
+
+def check_ascii_errors():
+    following = _ENTRY * 20000
+    chunk_size = 4096
+    for bad, message in _BAD_ENTRIES:
+        data = '[0.1] 2\nhi\n' + bad + following
+        fin = _CountingReader(data)
+        try:
+            list(iter_ascii(fin, chunk_size=chunk_size))
+        except ASCIIParseError as e:
+            _expect(message in str(e), 'expected %r, got %s', message, e)
+            _expect((e.entry_nr, e.line_nr) == (2, 3), '%r reported in entry %s line %s', bad, e.entry_nr,
+                    e.line_nr)
+        else:
+            raise CheckError('%r was accepted' % bad)
+        _expect(fin.read_bytes <= 2 * chunk_size, '%r: read %s bytes before reporting it', bad, fin.read_bytes)
+        fin = _CountingReader(data)
+        entries = list(iter_ascii(fin, lenient=True, chunk_size=chunk_size))
+        _expect(len(entries) == 20001, '%r: %s entries when lenient', bad, len(entries))
+        _expect(fin.read_bytes == len(data), '%r: read %s of %s bytes when lenient', bad, fin.read_bytes,
+                len(data))
+
+    #cut at the end of the input
+    for data, message in [('[0.1] 2\nhi\n[0.2] 10\nabc', 'payload of 10 bytes is not followed by a newline'),
+                          ('[0.1] 2\nhi\n[0.2] 1', 'header without newline')]:
+        for chunk_size in (1, 5, 4096):
+            try:
+                list(iter_ascii(BytesIO(data), chunk_size=chunk_size))
+            except ASCIIParseError as e:
+                _expect(message in str(e), 'expected %r, got %s', message, e)
+            else:
+                raise CheckError('%r was accepted' % data)
+            entries = list(iter_ascii(BytesIO(data), lenient=True, chunk_size=chunk_size))
+            _expect(len(entries) == 1, '%r: %s entries when lenient', data, len(entries))
+
+    #the chunk size (i.e. where entries are cut) mustn't matter, durations may be written by repr
+    entries = synthetic.input_heavy(0.01) + [(1e-05, 'x', None), (2.5e+20, '', 'i=0.1')]
+    fout = BytesIO()
+    for duration, payload, options in entries:
+        fout.write('[%r] %s%s\n%s\n' % (duration, len(payload), ' ' + options if options else '', payload))
+    expected = [(duration, payload, options) for duration, payload, options in entries]
+    for chunk_size in (1, 7, 100, 1 << 20):
+        result = list(iter_ascii(BytesIO(fout.getvalue()), chunk_size=chunk_size))
+        _expect(result == expected, 'reading in chunks of %s bytes gives other entries', chunk_size)
+
+def _full_screen(r, frames=150, rows=24, cols=80):
+    """Output of a program repainting the whole screen (like top), cut at random places."""
+    procs = [['%5d' % r.randint(1, 30000), r.choice(['root', 'user']), '%4.1f' % (r.random() * 10),
+              r.choice(['python', 'bash', 'nginx', 'vim'])] for _ in xrange(rows - 4)]
+    entries = [(0, '\x1b[?1049h\x1b[?25l\x1b]0;top\x07')]
+    for frame in xrange(frames):
+        out = ['\x1b[H\x1b[2J\x1b[1;37;44m top - %05d load average: %.2f \x1b[0m\r\n' % (frame, r.random())]
+        out.append('\x1b[7m  PID USER  %CPU COMMAND          \x1b[0m\r\n')
+        for proc in procs:
+            if r.random() < 0.1:
+                proc[2] = '%4.1f' % (r.random() * 10)
+            out.append('%s %-5s %s \x1b[32m%-10s\x1b[0m\r\n' % tuple(proc))
+        out.append('[%-40s]' % ('#' * (frame % 40)))
+        #the last column leaves the cursor waiting to wrap
+        out.append('\x1b[%sH%s' % (rows, ('status %s ' % frame).ljust(cols, '.')))
+        payload = ''.join(out)
+        cuts = sorted(r.sample(xrange(1, len(payload)), 3))
+        parts = [payload[start:end] for start, end in zip([0] + cuts, cuts + [len(payload)])]
+        entries.append((0.1, parts[0]))
+        entries.extend((0.001, part) for part in parts[1:])
+    entries.append((0.5, '\x1b[?25h\x1b[?1049l'))
+    return entries
+
+def _screen_state(screen):
+    return screen.chars, screen.attrs, screen.x, screen.y
+
+def check_redraws():
+    r = Random(3)
+    recordings = [('full screen', _full_screen(r)),
+                  ('shell', [(duration, payload) for duration, payload, _ in synthetic.input_heavy(0.01)])]
+    for name, entries in recordings:
+        original = list(_ttyrec(entries))
+        total = sum(entry.duration for entry in original)
+        for quantum in (0, 0.05, 0.5):
+            redrawn = list(_ttyrec(entries).minimize_redraws(quantum=quantum))
+            expected = Screen()
+            shown = Screen()
+            nr = 0
+            elapsed = 0.0
+            redrawn_elapsed = 0.0
+            for entry in redrawn:
+                redrawn_elapsed += entry.duration
+                while nr < len(original) and elapsed + original[nr].duration <= redrawn_elapsed + 1e-9:
+                    elapsed += original[nr].duration
+                    expected.feed(original[nr].payload)
+                    nr += 1
+                shown.feed(entry.payload)
+                _expect(_screen_state(expected) == _screen_state(shown),
+                        '%s with quantum %s: the screens differ after %.3f seconds', name, quantum, redrawn_elapsed)
+            _expect(abs(redrawn_elapsed - total) < 1e-6, '%s with quantum %s lasts %.3f instead of %.3f seconds',
+                    name, quantum, redrawn_elapsed, total)
+
+CHECKS = [('block_sub', check_block_sub), ('remove_window_size', check_remove_window_size),
+          ('ascii_errors', check_ascii_errors), ('redraws', check_redraws)]
+
+def main(argv=None):
+    parser = OptionParser(usage='%%prog [CHECK...]\n\nChecks: %s' % ', '.join(name for name, _ in CHECKS))
+    _, names = parser.parse_args(argv)
+    #the lenient parsing warns about the errors it's meant to skip
+    logging.basicConfig(level=logging.ERROR)
+    unknown = set(names) - set(name for name, _ in CHECKS)
+    if unknown:
+        parser.error('unknown checks: %s' % ', '.join(sorted(unknown)))
+    failed = 0
+    for name, check in CHECKS:
+        if names and name not in names:
+            continue
+        start = time.time()
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print 'FAILED %s\n%s' % (name, traceback.format_exc())
+        else:
+            print 'ok     %-20s %.2fs' % (name, time.time() - start)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
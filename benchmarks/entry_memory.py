@@ -0,0 +1,73 @@
+"""Memory taken by many live :class:`ttyrec.io.TTYrecEntry` objects::
+
+    python benchmarks/entry_memory.py [-n ENTRIES]
+
+Every case runs in its own process and reports how much its resident memory grew while
+holding all entries in a list. The payload is the same string for all of them so only the
+entries are measured. ``legacy`` is the entry as it was before using ``__slots__`` (an
+instance dictionary and an :class:`ttyrec.io.Options` for every entry).
+"""
+import os
+import sys
+import gc
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ttyrec.io import TTYrecEntry, Options
+
+class LegacyEntry(object):
+    def __init__(self, duration, payload, options=None):
+        self.duration = duration
+        self.payload = payload
+        if options:
+            self.options = options
+        else:
+            self.options = Options()
+
+def _rss():
+    """:returns: resident memory of this process in bytes."""
+    with open('/proc/self/statm') as fin:
+        return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def _plain(entry_type, count):
+    """Entries without options (e.g. read from a ttyrec file)."""
+    return [entry_type(0.01, 'x') for _ in xrange(count)]
+
+def _typed(entry_type, count):
+    """Entries sharing the options of the entry they come from (e.g. teletype)."""
+    options = Options.from_str('i=0.1')
+    return [entry_type(0.01, 'x', options) for _ in xrange(count)]
+
+CASES = [('plain', _plain), ('teletype', _typed)]
+TYPES = [('legacy', LegacyEntry), ('slots', TTYrecEntry)]
+
+def _measure(factory, entry_type, count, results):
+    gc.collect()
+    before = _rss()
+    entries = factory(entry_type, count)
+    results.put(_rss() - before)
+    del entries
+
+def measure(factory, entry_type, count):
+    """:returns: bytes the process grew creating count entries with factory."""
+    results = Queue()
+    process = Process(target=_measure, args=(factory, entry_type, count, results))
+    process.start()
+    grown = results.get()
+    process.join()
+    return grown
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [-n ENTRIES]')
+    parser.add_option('-n', '--entries', type='int', default=1000000)
+    options, _ = parser.parse_args(argv)
+    count = options.entries
+    print '%-10s %-8s %12s %10s' % ('case', 'entry', 'MB', 'bytes/entry')
+    for case, factory in CASES:
+        for name, entry_type in TYPES:
+            grown = measure(factory, entry_type, count)
+            print '%-10s %-8s %12.1f %10.1f' % (case, name, grown / 1048576.0, float(grown) / count)
+
+if __name__ == '__main__':
+    main()
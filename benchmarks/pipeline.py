@@ -0,0 +1,217 @@
+"""Throughput and memory of the loaders, effects and savers of :class:`ttyrec.io.TTYrecStream`::
+
+    python benchmarks/pipeline.py -o results.json
+    python benchmarks/pipeline.py -c results.json            #compare with a previous run
+    python benchmarks/pipeline.py -d input_heavy -b teletype --profile
+
+Every dataset of :mod:`synthetic` is written once to a temporary directory. Each benchmark
+runs in its own process: effects and savers are measured on top of ``load_ttyrec`` (or
+``load_ascii`` for the ones that need input marks) and the time of loading alone is subtracted. Frames and MB per second refer to the input recording,
+peak memory is the growth of the maximal resident memory of the process.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ttyrec.io import TTYrecStream
+
+import synthetic
+
+def _consume(stream):
+    frames = 0
+    for _ in stream:
+        frames += 1
+    return frames
+
+def _loaded(files):
+    return TTYrecStream().load_ttyrec(files['ttyrec'])
+
+def _marked(files):
+    #input is what makes teletype and delay_input do something
+    return TTYrecStream().load_ascii(files['ascii'])
+
+def _save(saver):
+    def run(files):
+        output = files['ttyrec'] + '.out'
+        getattr(_loaded(files), saver)(output)
+        os.remove(output)
+    return run
+
+def _effect(base, name, **args):
+    return lambda files: _consume(getattr(base(files), name)(**args))
+
+def _load_ttyrec(files):
+    _consume(_loaded(files))
+
+def _load_ascii(files):
+    _consume(_marked(files))
+
+#name: (what is subtracted, what is measured), both get the dictionary of files of a dataset
+BENCHMARKS = [
+    ('load_ttyrec', (None, _load_ttyrec)),
+    ('load_ascii', (None, _load_ascii)),
+    ('add_intro', (_load_ttyrec, _effect(_loaded, 'add_intro'))),
+    ('cap_delays', (_load_ttyrec, _effect(_loaded, 'cap_delays'))),
+    ('change_speed', (_load_ttyrec, _effect(_loaded, 'change_speed', speed=2.0))),
+    ('mark_input', (_load_ttyrec, _effect(_loaded, 'mark_input'))),
+    ('merge_lines', (_load_ttyrec, _effect(_loaded, 'merge_lines'))),
+    ('split_lines', (_load_ttyrec, _effect(_loaded, 'split_lines'))),
+    ('teletype', (_load_ascii, _effect(_marked, 'teletype'))),
+    ('delay_input', (_load_ascii, _effect(_marked, 'delay_input'))),
+    ('save_ttyrec', (_load_ttyrec, _save('save_ttyrec'))),
+    ('save_ascii', (_load_ttyrec, _save('save_ascii'))),
+]
+
+def _rss_kb():
+    with open('/proc/self/statm') as fin:
+        return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def _timed(func, files, repeat):
+    """:returns: best seconds of running func repeat times (0 if func is None)."""
+    if func is None:
+        return 0.0
+    best = None
+    for _ in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        func(files)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _run(benchmark, files, repeat, results):
+    baseline, measured = dict(BENCHMARKS)[benchmark]
+    try:
+        start_rss = _rss_kb()
+        seconds = max(0.0, _timed(measured, files, repeat) - _timed(baseline, files, repeat))
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        results.put((seconds, peak / 1024.0, None))
+    except Exception as e:
+        results.put((None, None, '%s: %s' % (type(e).__name__, e)))
+
+def run_benchmark(benchmark, files, repeat=3):
+    """Runs a benchmark in a new process.
+
+:returns: (seconds, peak memory growth in MB, error or None)."""
+    results = Queue()
+    process = Process(target=_run, args=(benchmark, files, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def profile(benchmark, files, profiler='cprofile', output=None):
+    """Runs a benchmark once in this process under a profiler and prints the results.
+
+:param profiler: 'cprofile' or 'pyinstrument' (if installed).
+:param output: file where the cProfile stats are saved (see :mod:`pstats`)."""
+    _, measured = dict(BENCHMARKS)[benchmark]
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        measured(files)
+        profiler.stop()
+        print profiler.output_text()
+        return
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.runcall(measured, files)
+    if output:
+        profiler.dump_stats(output)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """Prints the speed of results relative to a previous run (>1 is faster)."""
+    old = dict(((r['dataset'], r['benchmark']), r) for r in previous['results'] if r['seconds'] is not None)
+    print 'Compared with %s (%s)' % (previous.get('commit'), previous.get('date'))
+    for result in results['results']:
+        before = old.get((result['dataset'], result['benchmark']))
+        if before is None or result['seconds'] is None:
+            continue
+        speedup = before['seconds'] / result['seconds'] if result['seconds'] else float('inf')
+        print '%-12s %-13s %6.2fx speed %+8.1f MB' % (result['dataset'], result['benchmark'], speedup,
+                                                      result['peak_mb'] - before['peak_mb'])
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--dataset', action='append', default=None,
+                      help='only this dataset (may be repeated): %s' % ', '.join(name for name, _ in synthetic.DATASETS))
+    parser.add_option('-b', '--benchmark', action='append', default=None,
+                      help='only this benchmark (may be repeated): %s' % ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_option('-s', '--scale', type='float', default=1.0, help='multiplies the size of the datasets')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='runs of every benchmark, the best one counts')
+    parser.add_option('-o', '--output', default=None, help='json file where the results are stored')
+    parser.add_option('-c', '--compare', default=None, help='json file of a previous run')
+    parser.add_option('--profile', action='store_true', default=False,
+                      help='profile the (single) selected benchmark instead of measuring')
+    parser.add_option('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    parser.add_option('--profile-output', default=None, help='file for the cProfile stats')
+    options, _ = parser.parse_args(argv)
+
+    datasets = [(name, func) for name, func in synthetic.DATASETS if not options.dataset or name in options.dataset]
+    benchmarks = [name for name, _ in BENCHMARKS if not options.benchmark or name in options.benchmark]
+    if options.profile and (len(datasets) != 1 or len(benchmarks) != 1):
+        parser.error('select one dataset and one benchmark to profile')
+
+    directory = tempfile.mkdtemp(prefix='ttyrec-bench')
+    try:
+        results = {'commit': _commit(), 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+                   'scale': options.scale, 'repeat': options.repeat, 'results': []}
+        if not options.profile:
+            print '%-12s %-13s %10s %12s %9s %9s' % ('dataset', 'benchmark', 'seconds', 'frames/s', 'MB/s', 'peak MB')
+        for dataset, generate in datasets:
+            entries = generate(options.scale)
+            frames = len(entries)
+            size = sum(len(payload) for _, payload, _ in entries)
+            files = synthetic.write(entries, directory, dataset)
+            if options.profile:
+                profile(benchmarks[0], files, options.profiler, options.profile_output)
+                return 0
+            del entries
+            for benchmark in benchmarks:
+                seconds, peak, error = run_benchmark(benchmark, files, options.repeat)
+                result = {'dataset': dataset, 'benchmark': benchmark, 'frames': frames, 'bytes': size,
+                          'seconds': seconds, 'peak_mb': peak, 'error': error}
+                if error is None:
+                    result['frames_per_s'] = frames / seconds if seconds else None
+                    result['mb_per_s'] = size / 1048576.0 / seconds if seconds else None
+                    print '%-12s %-13s %10.3f %12.0f %9.1f %9.1f' % (dataset, benchmark, seconds,
+                            result['frames_per_s'] or 0, result['mb_per_s'] or 0, peak)
+                else:
+                    print '%-12s %-13s FAILED %s' % (dataset, benchmark, error)
+                sys.stdout.flush()
+                results['results'].append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if options.output:
+        with open(options.output, 'w') as fout:
+            json.dump(results, fout, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fin:
+            compare(results, json.load(fin))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
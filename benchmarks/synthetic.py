@@ -0,0 +1,72 @@
+"""Synthetic recordings for the benchmarks.
+
+Every generator returns a list of (duration, payload, options string or None) and is
+deterministic so results can be compared across commits. ``scale`` multiplies the number
+of frames.
+"""
+import os
+import sys
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ttyrec.io import TTYrecWriter
+
+_PROMPT = 'user@host:~/project $ '
+_WORDS = ('ls', 'cat', 'grep', 'make', 'python', 'error:', 'warning:', 'src/ttyrec/io.py', 'done',
+          '\x1b[1;31mFAILED\x1b[0m', '\x1b[32mok\x1b[0m', '42', 'build')
+
+def _line(r, words=8):
+    return ' '.join(r.choice(_WORDS) for _ in xrange(words)) + '\r\n'
+
+def tiny_frames(scale=1.0):
+    """Fast output written a few bytes at a time (e.g. a progress bar or a slow tty)."""
+    r = Random(1)
+    return [(r.random() * 0.002, _line(r)[:r.randint(1, 10)], None) for _ in xrange(int(200000 * scale))]
+
+def huge_frames(scale=1.0):
+    """Whole screens of 1MB (e.g. cat of a big file)."""
+    r = Random(2)
+    screen = ''.join(_line(r, 20) for _ in xrange(10000))[:1 << 20]
+    return [(0.5, screen, None) for _ in xrange(max(1, int(100 * scale)))]
+
+def input_heavy(scale=1.0):
+    """Shell session: prompts, typed commands (marked as input) and short outputs."""
+    r = Random(3)
+    entries = []
+    for _ in xrange(int(20000 * scale)):
+        entries.append((r.random(), _PROMPT, None))
+        entries.append((r.random() * 3, _line(r, 4).rstrip(), 'i=0.08'))
+        entries.append((0.01, '\r\n', None))
+        for _ in xrange(r.randint(0, 4)):
+            entries.append((r.random() * 0.01, _line(r), None))
+    return entries
+
+def idle_gaps(scale=1.0):
+    """Output bursts separated by long pauses (e.g. a session left open)."""
+    r = Random(4)
+    entries = []
+    for nr in xrange(int(50000 * scale)):
+        duration = r.random() * 0.05
+        if nr % 100 == 0:
+            duration = r.random() * 3600
+        entries.append((duration, _line(r), None))
+    return entries
+
+DATASETS = [('tiny_frames', tiny_frames), ('huge_frames', huge_frames), ('input_heavy', input_heavy),
+            ('idle_gaps', idle_gaps)]
+
+def write(entries, directory, name):
+    """Writes entries as ttyrec and ascii files (options are only kept in the ascii one).
+
+:returns: dictionary with the paths of the 'ttyrec' and 'ascii' files."""
+    tty_file = os.path.join(directory, name + '.tty')
+    ascii_file = os.path.join(directory, name + '.txt')
+    with open(tty_file, 'wb') as fout:
+        writer = TTYrecWriter(fout)
+        for duration, payload, _ in entries:
+            writer.write(duration, payload)
+        writer.flush()
+    with open(ascii_file, 'wb') as fout:
+        for duration, payload, options in entries:
+            fout.write('[%r] %s%s\n%s\n' % (duration, len(payload), ' ' + options if options else '', payload))
+    return {'ttyrec': tty_file, 'ascii': ascii_file}
@@ -0,0 +1,168 @@
+"""Applies the same effect pipeline to many recordings in parallel::
+
+    python -m ttyrec.batch -o /tmp/out -p '[{"name": "add_intro", "args": {}},
+        {"name": "cap_delays", "args": {"max_delay": 2}}, {"name": "merge_lines", "args": {}}]' \\
+        'recordings/*'
+
+The pipeline is a plan as exported by :meth:`ttyrec.io.TTYrecStream.to_json` (or a path to a
+file containing it). Loading stages are ignored, every input file is loaded instead.
+Outputs newer than their input and made with the same pipeline (as recorded in a manifest in
+the output directory) are skipped unless forced.
+Files are processed by a pool of worker processes and a failing file doesn't stop the others.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import traceback
+from multiprocessing import Pool
+from optparse import OptionParser
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import TTYrecStream, AtomicFile, expand_path, find_recordings, detect_compression
+
+_LOADERS = {'ttyrec': 'load_ttyrec', 'ascii': 'load_ascii'}
+_SAVERS = {'ttyrec': 'save_ttyrec', 'ascii': 'save_ascii'}
+
+MANIFEST_NAME = '.ttyrec-batch.json'
+"Name of the file recording the plan each output of a directory was made with."
+
+def read_plan(pipeline):
+    """:param pipeline: json plan or path to a file containing it.
+:returns: the json plan without loading stages."""
+    if os.path.isfile(expand_path(pipeline)):
+        with open(expand_path(pipeline)) as fin:
+            pipeline = fin.read()
+    plan = [stage for stage in json.loads(pipeline) if not stage['name'].startswith('load_')]
+    #fail here and not once per file if the plan is wrong
+    TTYrecStream().apply_plan(plan)
+    return json.dumps(plan, sort_keys=True)
+
+def plan_digest(plan, input_format, output_format):
+    """:returns: a hash of everything besides the input file that changes an output."""
+    return hashlib.sha1('%s\n%s\n%s' % (input_format, output_format, plan)).hexdigest()
+
+def read_manifest(output_dir):
+    """:returns: dict of output file name to the :func:`plan_digest` it was made with."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        #missing or broken, everything is processed again
+        return {}
+
+def save_manifest(output_dir, manifest):
+    with AtomicFile(os.path.join(output_dir, MANIFEST_NAME), 'w') as fout:
+        json.dump(manifest, fout, sort_keys=True, indent=0)
+
+def output_path(input_file, output_dir, suffix=''):
+    """:returns: the path of the result of processing input_file."""
+    return os.path.join(output_dir, os.path.basename(input_file) + suffix)
+
+def is_up_to_date(input_file, output_file, digest, manifest):
+    """:returns: if output_file exists, is newer than input_file and the manifest (see
+    :func:`read_manifest`) says it was made with the plan of the given digest."""
+    if manifest.get(os.path.basename(output_file)) != digest or not os.path.exists(output_file):
+        return False
+    return os.path.getmtime(input_file) <= os.path.getmtime(output_file)
+
+def convert(job):
+    """Processes one file, all errors are returned instead of raised so a failing file doesn't
+stop the others.
+
+:param job: tuple of (input file, output file, json plan, input format, output format)
+:returns: tuple of (input file, output file, error message or None, seconds spent)"""
+    input_file, output_file, plan, input_format, output_format = job
+    start = time.time()
+    try:
+        stream = getattr(TTYrecStream(), _LOADERS[input_format])(input_file).apply_plan(plan)
+        #the extension of the output (not of the temporary file) tells which compression to use
+        with AtomicFile(output_file, 'wb', detect_compression(output_file, 'wb')) as fout:
+            getattr(stream, _SAVERS[output_format])(fout)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return input_file, output_file, error, time.time() - start
+
+def run(jobs, processes=None, report=None):
+    """Runs all jobs (see :func:`convert`) in parallel.
+
+:param processes: number of worker processes, defaults to the number of cpus.
+:param report: function called with the result of each job as soon as it finishes.
+:returns: list of the results of all jobs (in the order they finished)."""
+    results = []
+    if processes == 1 or len(jobs) < 2:
+        finished = (convert(job) for job in jobs)
+        pool = None
+    else:
+        pool = Pool(processes)
+        finished = pool.imap_unordered(convert, jobs)
+    try:
+        for result in finished:
+            results.append(result)
+            if report is not None:
+                report(result)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return results
+
+def main(argv=None):
+    parser = OptionParser(prog='ttyrec-batch', usage='%prog [options] -p PIPELINE -o OUTPUT_DIR GLOB...')
+    parser.add_option('-p', '--pipeline', help='json plan or file containing it')
+    parser.add_option('-o', '--output-dir', help='directory where results are stored')
+    parser.add_option('-s', '--suffix', default='', help='appended to the name of the result files')
+    parser.add_option('-i', '--input-format', choices=list(_LOADERS), default='ttyrec')
+    parser.add_option('-f', '--output-format', choices=list(_SAVERS), default='ttyrec')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='number of parallel processes (default: number of cpus)')
+    parser.add_option('--force', action='store_true', default=False,
+                      help='process files even if their result is up to date')
+    options, patterns = parser.parse_args(argv)
+    if not options.pipeline or not options.output_dir or not patterns:
+        parser.error('pipeline, output directory and at least one input are required')
+
+    plan = read_plan(options.pipeline)
+    digest = plan_digest(plan, options.input_format, options.output_format)
+    output_dir = expand_path(options.output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifest = read_manifest(output_dir)
+
+    inputs = find_recordings(patterns)
+    jobs = []
+    for input_file in inputs:
+        output_file = output_path(input_file, output_dir, options.suffix)
+        if options.force or not is_up_to_date(input_file, output_file, digest, manifest):
+            jobs.append((input_file, output_file, plan, options.input_format, options.output_format))
+    print 'Processing %s files (%s up to date)' % (len(jobs), len(inputs) - len(jobs))
+
+    done = [0]
+    def report(result):
+        done[0] += 1
+        input_file, output_file, error, elapsed = result
+        if error is None:
+            manifest[os.path.basename(output_file)] = digest
+            print '[%s/%s] %s -> %s (%.2fs)' % (done[0], len(jobs), input_file, output_file, elapsed)
+        else:
+            print '[%s/%s] FAILED %s\n%s' % (done[0], len(jobs), input_file, error)
+        sys.stdout.flush()
+    try:
+        results = run(jobs, options.jobs, report)
+    finally:
+        #also keep what was done if interrupted
+        if jobs:
+            save_manifest(output_dir, manifest)
+    failed = [result for result in results if result[2] is not None]
+    if failed:
+        print '%s files failed:\n\t%s' % (len(failed), '\n\t'.join(result[0] for result in failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
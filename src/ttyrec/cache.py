@@ -0,0 +1,214 @@
+"""Disk cache of processed recordings::
+
+    from ttyrec.io import TTYrecStream
+
+    #processed only the first time (or when the file or the effects change)
+    stream = TTYrecStream().load_ttyrec('tutorial.tty').add_intro().cap_delays().merge_lines().cached()
+
+The result of a stream is stored as a ttyrec file named after a hash of its plan (see
+:meth:`ttyrec.io.TTYrecStream.plan`) and of the files it reads: their size and modification
+time, or their whole content if ``hash_content`` is set. Only streams whose plan can be
+exported to json and that read files can be cached. Options of the entries (e.g. input
+marks) are not stored.
+
+Using a cached result marks it as recently used. When the cache grows over its size limit
+the least recently used results are removed, except the ones used in the last minute
+(another process may be about to read them). Results are written to a temporary file and
+renamed, and the removal is done holding a lock, so several processes can share a cache.
+"""
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import TTYrecStream, TTYrecWriter, AtomicFile, expand_path
+
+CACHE_DIR = '~/.cache/ttyrec'
+MAX_SIZE = 512 << 20
+"Default size limit of the cache in bytes."
+MIN_AGE = 60
+"Seconds a result is kept after being used, even if the cache is full (it may still be read)."
+
+_SUFFIX = '.tty'
+_LOCK = '.lock'
+#changes when the stored format or the key do
+_VERSION = 1
+#arguments of the loaders naming the files they read
+_SOURCE_ARGS = {'load_ttyrec': 'tty_file', 'load_ascii': 'ascii_file', 'load_concat': 'sources',
+                'load_merge': 'sources', 'load_cached': 'tty_file'}
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ResultCache(object):
+    """Directory with the results of processed streams."""
+    def __init__(self, directory=CACHE_DIR, max_size=MAX_SIZE, hash_content=False, min_age=MIN_AGE):
+        """
+:param directory: where results are stored, created if required.
+:param max_size: bytes the results may take before the least recently used are removed.
+:param hash_content: identify input files by their content instead of their size and
+    modification time (slower, but survives copies and touches).
+:param min_age: seconds a result is kept after being used, so other processes can start
+    reading it, even if the cache is over its size limit."""
+        self.directory = expand_path(directory)
+        self.max_size = max_size
+        self.hash_content = hash_content
+        self.min_age = min_age
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _source_files(self, stream):
+        stages = stream.stages
+        if not stages or not stages[0].source or stages[0].name not in _SOURCE_ARGS:
+            raise ValueError("Only streams loading files can be cached")
+        args = stages[0].args
+        if args.get('follow'):
+            raise ValueError("Streams following a file being written can't be cached")
+        files = args[_SOURCE_ARGS[stages[0].name]]
+        if isinstance(files, basestring):
+            files = [files]
+        for path in files:
+            if not isinstance(path, basestring):
+                raise ValueError("Only streams loading files can be cached")
+        return [expand_path(path) for path in files]
+
+    def key(self, stream):
+        """:returns: the hash identifying the result of stream.
+:raises ValueError: if the stream can't be cached."""
+        try:
+            plan = stream.to_json(sort_keys=True)
+        except TypeError as e:
+            raise ValueError("The plan can't be exported: %s" % e)
+        digest = hashlib.sha1('%s\n%s\n' % (_VERSION, plan))
+        for path in self._source_files(stream):
+            if self.hash_content:
+                digest.update(_file_digest(path))
+            else:
+                stat = os.stat(path)
+                digest.update('%s %r %r\n' % (path, stat.st_size, stat.st_mtime))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, stream):
+        """:returns: the path of the cached result of stream (marking it as used) or None."""
+        path = self.path(self.key(stream))
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def put(self, stream):
+        """Processes stream and stores the result (removing old results if the cache is full).
+
+:returns: the path of the result."""
+        path = self.path(self.key(stream))
+        with AtomicFile(path) as fout:
+            writer = TTYrecWriter(fout)
+            for nr, entry in enumerate(stream):
+                if nr == 0 and entry.duration:
+                    #ttyrec files can't wait before the first entry, an empty one does it
+                    writer.write(0, '')
+                writer.write(entry.duration, entry.payload)
+            writer.flush()
+        self.evict(keep=path)
+        return path
+
+    def load(self, stream):
+        """:returns: a :class:`ttyrec.io.TTYrecStream` reading the result of stream (processing
+    and storing it first if it isn't cached). Every iteration opens the result, if it was
+    removed from the cache meanwhile stream is processed and stored again."""
+        path = self.get(stream)
+        if path is None:
+            log.debug('Cache miss for %s', stream.plan())
+            path = self.put(stream)
+        def gen():
+            try:
+                fin = open(path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                log.debug('%s was removed from the cache, processing %s again', path, stream.plan())
+                fin = open(self.put(stream), 'rb')
+            #the open file can still be read if the result is removed
+            with fin:
+                for entry in TTYrecStream().load_ttyrec(fin):
+                    yield entry
+        return TTYrecStream()._set_source('load_cached', gen, tty_file=path)
+
+    def _entries(self):
+        """:returns: list of (last used, size, path) of all results."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                #removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """:returns: bytes taken by all results."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_size=None, keep=None, min_age=None):
+        """Removes the least recently used results until they take at most max_size bytes
+(the size limit of the cache by default).
+
+:param keep: path of a result that mustn't be removed (e.g. the one about to be read).
+:param min_age: results used within these seconds are kept (by default the ones of the cache)."""
+        if max_size is None:
+            max_size = self.max_size
+        if min_age is None:
+            min_age = self.min_age
+        oldest = time.time() - min_age
+        with open(os.path.join(self.directory, _LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = sorted(self._entries())
+                total = sum(size for _, size, _ in entries)
+                for used, size, path in entries:
+                    if total <= max_size or used > oldest:
+                        break
+                    if path == keep:
+                        continue
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                    total -= size
+                    log.debug('Removed %s from the cache', path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def clear(self):
+        """Removes all results."""
+        self.evict(0, min_age=0)
+
+_default = None
+
+def default_cache():
+    """:returns: the :class:`ResultCache` at :data:`CACHE_DIR`."""
+    global _default
+    if _default is None:
+        _default = ResultCache()
+    return _default
@@ -1,37 +1,51 @@
-"""This effects are thought as examples of what can be used for the raw_effect
-They would be used like::
+"""This effects are thought as examples of what can be used for the raw_effect and
+batch_effect. They would be used like::
 
-    TTYrecStream().read_ascii('file.ascii').delay_lines(delay_per_line=0.05).raw_effect(
-        LinearInputDelay(start_delay=0.1, end_delay=0.01, duration=600).linear_delay)\
-        .write_ascii('/tmp/test1.ascii')
+    TTYrecStream().load_ascii('file.ascii').split_lines(delay_per_line=0.05).raw_effect(
+        LinearInputDelay(start_delay=0.1, end_delay=0.01, duration=600).linear_delay)\\
+        .batch_effect(RemoveWindowSize).save_ascii('/tmp/test1.ascii')
 
 """
-from ttyrec.utils import to_timestamp
+import re
 
 class LinearInputDelay(object):
     def __init__(self, start_delay=0.1, end_delay=0.01, duration=600):
         self.start_delay = start_delay
         self.end_delay = end_delay
         self.duration = duration
-        self.start = None
-        self.last = None
-    def linear_delay(self, tstamp, payload, options):
-        if self.start is None:
-            self.start = tstamp
+        self.time = None
+    def linear_delay(self, entry):
+        """Sets the typing delay of input entries, going from start_delay to end_delay
+during the first duration seconds of the recording."""
+        if self.time is None:
+            self.time = 0.0
         else:
-            if 'i' in options:
+            self.time += entry.duration
+            if entry.has_option('i'):
                 #just interpolate linearly between the two values
-                if tstamp < self.last:
-                    print self.last, tstamp, repr(payload), options
-                factor = min(to_timestamp(tstamp - self.start), self.duration)/self.duration
-                options['i']= self.start_delay * (1 - factor) + self.end_delay * factor
-        self.last = tstamp
-        return tstamp, payload, options
+                factor = min(self.time, self.duration)/self.duration
+                entry.options['i'] = self.start_delay * (1 - factor) + self.end_delay * factor
+        return entry
 
-def RemoveWindowSize(generator):
-    import re
-    cr = re.compile(r' \r(:?[^\n]|$)')
-    for items in generator:
-        #tstamp, payload, options = items[:3]
-        items = [items[0], cr.sub(r'\1', items[1])] + list(items[2:])
-        yield tuple(items)
\ No newline at end of file
+#spaces followed by a carriage return, but not the ones ending a line
+_WINDOW_SIZE = re.compile(r' \r(?!\n)')
+#the same, except at the end (what follows it is in the next block)
+_WINDOW_SIZE_IN_BLOCK = re.compile(r' \r(?!\n|\Z)')
+
+def RemoveWindowSize(block):
+    """Removes ' \\r' (not followed by a new line) from a :class:`ttyrec.io.Block`, also
+when it's split between entries or blocks."""
+    if block.last:
+        block.sub(_WINDOW_SIZE, '')
+        return block.split()
+    #the end may be the start of ' \r\n' (it isn't replaced, so it stays the end)
+    data = block.data
+    unknown = 0
+    if data.endswith(' \r'):
+        unknown = 2
+    elif data.endswith(' '):
+        unknown = 1
+    block.sub(_WINDOW_SIZE_IN_BLOCK, '')
+    if unknown:
+        block.hold(len(block.data) - unknown)
+    return block.split()
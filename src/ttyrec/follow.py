@@ -0,0 +1,117 @@
+"""Waiting for files that are still being written (e.g. by ttyrec while recording).
+
+:class:`FileWatcher` uses inotify on linux and falls back to polling the file size and
+modification time anywhere else. It's used by ``TTYrecStream.load_ttyrec(..., follow=True)``::
+
+    from ttyrec.io import Player, TTYrecStream
+
+    #watch a session while it's being recorded
+    Player(TTYrecStream().load_ttyrec('/tmp/live_session', follow=True)).play()
+"""
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+import logging
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+"Seconds between checks when the file can't be watched with inotify."
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_libc = None
+
+def _inotify_watch(path):
+    """:returns: an inotify file descriptor watching path or None if inotify isn't available."""
+    global _libc
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if _libc.inotify_add_watch(fd, path, _IN_MODIFY | _IN_CLOSE_WRITE | _IN_DELETE_SELF | _IN_MOVE_SELF) < 0:
+        log.debug('Could not watch %s: %s', path, os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+class FileWatcher(object):
+    """Waits for a file to change."""
+    def __init__(self, path, poll_interval=POLL_INTERVAL, use_inotify=True):
+        """
+:param path: file to watch.
+:param poll_interval: seconds between checks if polling.
+:param use_inotify: try to use inotify (only on linux)."""
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+        if use_inotify:
+            self._fd = _inotify_watch(path)
+        self._last = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def wait(self, timeout=None):
+        """Blocks until the file changes or timeout seconds (None for ever) pass.
+
+:returns: False if it timed out."""
+        if self._fd is not None:
+            while True:
+                try:
+                    ready = select.select([self._fd], [], [], timeout)[0]
+                    break
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            if not ready:
+                return False
+            #drain the events, we only care that something happened
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            return True
+
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            current = self._stat()
+            if current != self._last:
+                self._last = current
+                return True
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(self.poll_interval if end is None else
+                       max(0, min(self.poll_interval, end - time.time())))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
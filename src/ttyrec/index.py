@@ -0,0 +1,129 @@
+"""Sidecar index of ttyrec files for random access.
+
+The index holds the cumulative time and the byte offset of every entry (the entry number is
+the position in the index). It's stored next to the recording (``<file>.idx``) and rebuilt
+automatically whenever the size or modification time of the recording changes::
+
+    from ttyrec.io import TTYrecStream
+
+    #only minutes 90 to 95 are read from disk
+    TTYrecStream().load_ttyrec('/tmp/a_file').slice(90*60, 95*60).save_ttyrec('/tmp/trimmed')
+"""
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from struct import Struct, error as StructError
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import Stream, Sidecar, TTYrecError, TruncatedEntryError, iter_records, expand_path
+
+INDEX_SUFFIX = '.idx'
+"Suffix appended to the recording path for storing its index."
+
+_MAGIC = 'TTYRIDX1'
+_INDEX_HEADER = Struct('<8sQdQ')
+"""Header of the index file::
+
+    magic, size of the indexed file, mtime of the indexed file, number of entries
+
+followed by the little endian doubles of the times and then those of the offsets."""
+
+def _to_file(values, fout):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(fout)
+
+def _from_file(fin, count):
+    values = array('d')
+    values.fromfile(fin, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+class FrameIndex(Sidecar):
+    """Time and byte offset of every entry of a ttyrec file."""
+    SUFFIX = INDEX_SUFFIX
+    KIND = 'index'
+
+    def __init__(self, times=None, offsets=None, size=None, mtime=None):
+        """
+:param times: seconds since the first entry for every entry.
+:param offsets: byte offset of every entry.
+:param size: size of the indexed file.
+:param mtime: modification time of the indexed file."""
+        self.times = times if times is not None else array('d')
+        self.offsets = offsets if offsets is not None else array('d')
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def build(tty_file):
+        """Indexes the given ttyrec file in one pass. A truncated last entry is left out.
+
+:param tty_file: path to a ttyrec binary file.
+:returns: the :class:`FrameIndex` of the file."""
+        tty_file = expand_path(tty_file)
+        stat = os.stat(tty_file)
+        index = FrameIndex(size=stat.st_size, mtime=stat.st_mtime)
+        times = index.times
+        offsets = index.offsets
+        first = None
+        with Stream(tty_file, 'rb') as fin:
+            try:
+                for offset, sec, usec, _ in iter_records(fin, zero_copy=True):
+                    tstamp = sec + usec / 1000000.0
+                    if first is None:
+                        first = tstamp
+                    times.append(tstamp - first)
+                    offsets.append(offset)
+            except TruncatedEntryError as e:
+                log.debug('%s: %s', tty_file, e)
+        return index
+
+    def dump(self, fout):
+        """Writes the index to the given binary stream (see :meth:`save`)."""
+        fout.write(_INDEX_HEADER.pack(_MAGIC, self.size, self.mtime, len(self)))
+        _to_file(self.times, fout)
+        _to_file(self.offsets, fout)
+
+    @staticmethod
+    def load(idx_file):
+        """Reads a stored index.
+
+:param idx_file: path of the index file.
+:returns: the stored :class:`FrameIndex`."""
+        with open(idx_file, 'rb') as fin:
+            try:
+                magic, size, mtime, count = _INDEX_HEADER.unpack(fin.read(_INDEX_HEADER.size))
+                if magic != _MAGIC:
+                    raise TTYrecError('%s is not a ttyrec index' % idx_file)
+                times = _from_file(fin, count)
+                offsets = _from_file(fin, count)
+            except (StructError, EOFError):
+                raise TTYrecError('Index %s is corrupted' % idx_file)
+        return FrameIndex(times, offsets, size, mtime)
+
+    def frame_at(self, tstamp):
+        """:returns: the number of the first entry recorded at or after tstamp seconds."""
+        return bisect_left(self.times, tstamp)
+
+    def time(self, frame):
+        """:returns: seconds from the beginning until the given entry."""
+        return self.times[frame]
+
+    def offset(self, frame):
+        """:returns: the byte offset of the given entry."""
+        return int(self.offsets[frame])
+
+    def frame_range(self, start=None, end=None):
+        """:returns: the (first, stop) entry numbers of the entries recorded between start
+    (inclusive) and end (exclusive) seconds from the beginning."""
+        first = self.frame_at(start) if start else 0
+        stop = self.frame_at(end) if end is not None else len(self)
+        return first, max(first, stop)
@@ -3,50 +3,377 @@ Created on 08.02.2013
 
 @author: estani
 '''
+from __future__ import absolute_import
 
-class Item(object):
-    def __init__(self, value, previous=None):
-        self.value = value
-        self.next = None
-        
-        if previous:
-            self.previous = previous
-            previous.next = self
-    def detach(self):
-        self.next.previous = None
-        self.next = None
-    def __repr__(self):
-        return self.value.__repr__()
-
-class BufferedGenerator(object):
-    def __init__(self, generator, buffersize=4):
-        self.size = buffersize
-        self._gen = generator
-    def __iter__(self):
-        previous=None
-        end=None
-        count = self.size
-        for i in self._gen:
-            current = Item(i, previous=previous)
-            
-            if count == 0:
-                end = end.next
-                end.previous.detach()                
-            else:
-                if count == self.size:
-                    end = current
-                count -= 1
-            yield current
-            previous=current
-                
-from struct import unpack, pack
+from struct import Struct
 from datetime import datetime, timedelta
-from inspect import currentframe, getargvalues
+import json
 import re
 import os
+import io
+import mmap
+import heapq
+from itertools import islice, chain, izip, imap
+from operator import attrgetter
+from bisect import bisect_left, bisect_right
+from glob import glob
+from collections import deque
+from timeit import default_timer
+from Queue import Queue, Full, Empty
+import threading
+import sys
+import logging
+log = logging.getLogger(__name__)
 
 from ttyrec.utils import to_datetime, to_timestamp, to_timestamp_tuple, to_timedelta
 
+class Window(object):
+    """The current item of an iteration and some of the ones around it (see :func:`windowed`).
+``window[0]`` is the current item, ``window[-1]`` the previous one, ``window[1]`` the next
+one and so on; items outside the window (or beyond the ends) are None."""
+    __slots__ = ('_items', '_position')
+
+    def __init__(self, lookback=1, lookahead=0):
+        self._items = deque(maxlen=lookback + 1 + lookahead)
+        self._position = 0
+
+    def __getitem__(self, offset):
+        index = self._position + offset
+        if 0 <= index < len(self._items):
+            return self._items[index]
+        return None
+
+    @property
+    def current(self):
+        return self._items[self._position]
+
+    def past(self):
+        """:returns: list of the previous items in the window (oldest first)."""
+        return list(islice(self._items, 0, self._position))
+
+    def future(self):
+        """:returns: list of the following items in the window."""
+        return list(islice(self._items, self._position + 1, None))
+
+    def __repr__(self):
+        return 'Window(%r, %r, %r)' % (self.past(), self.current, self.future())
+
+def windowed(iterable, lookback=1, lookahead=0):
+    """Iterates keeping the items around the current one at hand.
+Only lookback + 1 + lookahead items are held at any time.
+
+:param lookback: number of previous items kept.
+:param lookahead: number of following items read in advance.
+:returns: generator of a :class:`Window` for every item. It's always the same object moved
+    forward, so keep the items and not the window."""
+    window = Window(lookback, lookahead)
+    items = window._items
+    iterator = iter(iterable)
+    items.extend(islice(iterator, lookahead + 1))
+    position = 0
+    while position < len(items):
+        window._position = position
+        yield window
+        full = len(items) == items.maxlen
+        for item in iterator:
+            #the oldest item is dropped if the window is full, moving the rest one back
+            items.append(item)
+            if not full:
+                position += 1
+            break
+        else:
+            #nothing left to read, only move forward
+            if position < lookback:
+                position += 1
+            else:
+                items.popleft()
+
+BLOCK_SIZE = 1 << 20
+"Payload bytes joined in a :class:`Block` by default."
+#most entries read at once while filling a block
+_BLOCK_CHUNK = 256
+#most entries in a block (holding many small objects slows down the garbage collector)
+BLOCK_ENTRIES = 1024
+
+_payload = attrgetter('payload')
+
+def _sub_matches(matches):
+    """Drops the empty matches right after the previous match, which re.sub skips."""
+    end = None
+    for m in matches:
+        if m.start() == m.end() == end:
+            continue
+        end = m.end()
+        yield m
+
+class Block(object):
+    """Consecutive entries seen as one buffer, so text operations (regular expressions,
+searches...) run once over all of them instead of once per entry. ``data`` is the joined
+payloads and ``ends[n]`` the offset in it where the payload of ``entries[n]`` ends; both are
+only built when used. See :meth:`TTYrecStream.batch_effect`.
+
+What follows the block is unknown (unless ``last`` is set), an effect depending on it can
+:meth:`hold` the end of the block back until the next one."""
+    __slots__ = ('entries', 'pos', 'last', 'held', '_payloads', '_data', '_ends', '_changed')
+
+    def __init__(self, entries, payloads=None, pos=0, last=False):
+        """
+:param entries: list of :class:`TTYrecEntry`.
+:param payloads: list of their payloads (read from the entries if None).
+:param pos: offset in data where the text not processed yet starts (the entries before
+    it were held back by the previous block).
+:param last: if no entries follow the block."""
+        self.entries = entries
+        self.pos = pos
+        self.last = last
+        #index of the first entry held back
+        self.held = None
+        self._payloads = payloads
+        self._data = None
+        self._ends = None
+        self._changed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def payloads(self):
+        """List with the payload of every entry (as they were before :meth:`sub`, until
+:meth:`split` is called)."""
+        if self._payloads is None:
+            self._payloads = map(_payload, self.entries)
+        return self._payloads
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = ''.join(self.payloads)
+        return self._data
+
+    @property
+    def ends(self):
+        if self._ends is None:
+            ends = []
+            end = 0
+            for size in imap(len, self.payloads):
+                end += size
+                ends.append(end)
+            self._ends = ends
+        return self._ends
+
+    def entry_at(self, offset):
+        """:returns: the index of the entry whose payload contains data[offset]."""
+        return bisect_right(self.ends, offset)
+
+    def start(self, index):
+        """:returns: the offset where the payload of entries[index] starts."""
+        return self.ends[index - 1] if index else 0
+
+    def hold(self, offset):
+        """Holds back the entries from the one with data[offset] until the next block, which
+starts with them and processes data from offset on (e.g. to see what follows a partial
+match). It does nothing in the last block."""
+        if not self.last:
+            self.held = bisect_right(self.ends, offset)
+            self.pos = offset
+
+    def sub(self, pattern, repl):
+        """Replaces pattern in the buffer from :attr:`pos` on (like ``re.sub``). A match spanning
+several entries is replaced in the first one, the others lose their part of it.
+
+:param pattern: regular expression (string or compiled).
+:param repl: replacement string (with group references) or function getting the match.
+:returns: number of replacements"""
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        data = self.data
+        ends = self.ends
+        if len(ends) == 1 and not self.pos:
+            #no boundaries to move
+            data, replaced = pattern.subn(repl, data)
+            if replaced:
+                self._data = data
+                self._ends = [len(data)]
+                self._changed = True
+            return replaced
+        found = pattern.finditer(data, self.pos)
+        if pattern.match(''):
+            found = _sub_matches(found)
+        if callable(repl):
+            matches = [(m.start(), m.end(), repl(m)) for m in found]
+        elif '\\' in repl:
+            matches = [(m.start(), m.end(), m.expand(repl)) for m in found]
+        else:
+            matches = [m.span() + (repl,) for m in found]
+        if not matches:
+            return 0
+        new_ends = []
+        pieces = []
+        pos = 0
+        index = 0
+        shift = 0
+        size = len(data)
+        for start, end, replacement in matches:
+            if start < size:
+                before = bisect_right(ends, start, index)
+            else:
+                #what is added at the end goes to the last entries
+                before = bisect_left(ends, start, index)
+            if shift:
+                new_ends.extend([offset + shift for offset in ends[index:before]])
+            else:
+                new_ends.extend(ends[index:before])
+            #entries ending within the match end after its replacement
+            inside = bisect_right(ends, end, before)
+            new_ends.extend([start + shift + len(replacement)] * (inside - before))
+            pieces.append(data[pos:start])
+            pieces.append(replacement)
+            pos = end
+            shift += len(replacement) - (end - start)
+            index = inside
+        new_ends.extend([offset + shift for offset in ends[index:]])
+        pieces.append(data[pos:])
+        self._data = ''.join(pieces)
+        self._ends = new_ends
+        self._changed = True
+        return len(matches)
+
+    def split(self):
+        """Sets the payloads of the entries from the (changed) buffer.
+
+:returns: the entries (except the ones held back)"""
+        if self._changed:
+            data = self._data
+            start = 0
+            payloads = self._payloads = []
+            for entry, end in izip(self.entries, self._ends):
+                entry.payload = payload = data[start:end]
+                payloads.append(payload)
+                start = end
+            self._changed = False
+        if self.held is not None:
+            return self.entries[:self.held]
+        return self.entries
+
+def _held(block):
+    """:returns: the entries held back by block and where their unprocessed data starts."""
+    if block.held is None:
+        return [], 0
+    return block.entries[block.held:], block.pos - block.start(block.held)
+
+def blocks(iterable, block_size=BLOCK_SIZE):
+    """:returns: generator of :class:`Block` of the entries of iterable, each with at least
+    block_size bytes of payload or :data:`BLOCK_ENTRIES` entries (except the last one).
+    Entries are read ahead up to the end of the block, a block_size of 1 gives one entry
+    per block."""
+    iterator = iter(iterable)
+    entries = []
+    payloads = []
+    size = 0
+    chunk_size = 1
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            break
+        chunk_payloads = map(_payload, chunk)
+        entries.extend(chunk)
+        payloads.extend(chunk_payloads)
+        chunk_bytes = sum(imap(len, chunk_payloads))
+        size += chunk_bytes
+        if size >= block_size or len(entries) >= BLOCK_ENTRIES:
+            yield Block(entries, payloads)
+            entries = []
+            payloads = []
+            size = 0
+        #about as many entries as are left to fill the block
+        chunk_size = max(1, min(_BLOCK_CHUNK, (block_size - size) * len(chunk) // (chunk_bytes or 1)))
+    if entries:
+        yield Block(entries, payloads)
+
+_PREFETCH_BATCH = 64
+
+def _produce(iterable, queue, stop, batch):
+    """Reads iterable into queue in lists of batch items until it's exhausted or stop is set.
+The last list is followed by None, or by the exception info if reading failed."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    try:
+        items = []
+        for item in iterable:
+            items.append(item)
+            if len(items) >= batch:
+                if not put(items):
+                    return
+                items = []
+        if items and not put(items):
+            return
+        put(None)
+    except Exception:
+        put(sys.exc_info())
+
+def prefetched(iterable, size=1024, batch=_PREFETCH_BATCH):
+    """Reads iterable in a background thread (e.g. so reading from a slow disk overlaps with
+processing). Exceptions are raised when reached.
+
+:param size: maximal number of items read in advance.
+:param batch: items passed together between the threads.
+:returns: generator of the items of iterable."""
+    queue = Queue(max(1, size // batch))
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce, args=(iterable, queue, stop, batch), name='ttyrec-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            items = queue.get()
+            if items is None:
+                return
+            if isinstance(items, tuple):
+                raise items[0], items[1], items[2]
+            for item in items:
+                yield item
+    finally:
+        #the consumer may stop early
+        stop.set()
+
+class _Reader(object):
+    """Reads an iterable in a background thread so the next item can be waited for with a
+timeout (e.g. while reacting to keys)."""
+    def __init__(self, iterable, size=64):
+        """
+:param size: maximal number of items read in advance."""
+        self._queue = Queue(size)
+        self._stop = threading.Event()
+        self._done = False
+        thread = threading.Thread(target=_produce, args=(iterable, self._queue, self._stop, 1),
+                                  name='ttyrec-reader')
+        thread.daemon = True
+        thread.start()
+
+    def get(self, timeout):
+        """:returns: the next item or None at the end.
+:raises Empty: if nothing came within timeout seconds."""
+        if self._done:
+            return None
+        items = self._queue.get(timeout=timeout)
+        if items is None:
+            self._done = True
+            return None
+        if isinstance(items, tuple):
+            self._done = True
+            raise items[0], items[1], items[2]
+        return items[0]
+
+    def close(self):
+        """Stops reading (the thread ends when it gets the next item)."""
+        self._stop.set()
+
 _HEADER = '<lli'    
 """Each entry of ttyrec is preceded by a 12byte header::
 
@@ -61,14 +388,23 @@ length: length of the following payload in bytes.
 _HEADER_SIZE = 3*4
 "3 * 4 (12) bytes"
 
+_HEADER_STRUCT = Struct(_HEADER)
+"Precompiled :data:`_HEADER` for walking whole buffers with ``unpack_from``."
+
+_READ_CHUNK = 1024 * 1024
+"Size of the blocks read when the input can't be memory-mapped (or walked at once when it can)."
+
 _TIMESTAMP = '%Y-%m-%d %H:%M:%S.%f'
 _TIMESTAMP_OFFSET = '%s.%f'
 "This is the format of the exported time stamp when converting to/from ascii."
 
-_ASCII_HEAD = re.compile('^\[([0-9:. -]*)\] ([0-9]*)(?: ([a-z,=.A-Z0-9]*))?$')
-"For extracting the header info stored in ascii."
+_ASCII_ENTRY_HEAD = re.compile(r'\[([0-9:. e+-]*)\] ([0-9]+)(?: ([a-z,=.A-Z0-9]*))?\n')
+"For matching the header line of an ascii entry at any position of a buffer."
 
 class Options(dict):
+    #number of entries using them (see TTYrecEntry.options)
+    _owners = 0
+
     @staticmethod
     def from_str(opt_str):
         parsed_dict = {}
@@ -91,13 +427,474 @@ class Options(dict):
                 values.append('%s=%s' % (key, value))
         return ','.join(values)     
 
+class TTYrecError(Exception):
+    """Base class for all problems found in ttyrec data."""
+
+class TruncatedEntryError(TTYrecError):
+    """The last entry of a ttyrec file is incomplete (e.g. the recording was interrupted)."""
+    def __init__(self, offset, expected, found):
+        TTYrecError.__init__(self, 'Truncated entry at byte %s: expected %s bytes, found %s' %
+                             (offset, expected, found))
+        self.offset = offset
+        self.expected = expected
+        self.found = found
+
+try:
+    _view = buffer
+except NameError:
+    #python 3
+    def _view(data, start, length):
+        return memoryview(data)[start:start + length]
+
+def _parse_records(data, offset, size, zero_copy=False):
+    """Walks all complete records in data[offset:size].
+
+:returns: a tuple with a list of (offset, sec, usec, payload) and the offset where the first
+    incomplete record starts."""
+    unpack_from = _HEADER_STRUCT.unpack_from
+    records = []
+    while offset + _HEADER_SIZE <= size:
+        sec, usec, length = unpack_from(data, offset)
+        if length < 0:
+            raise TTYrecError('Invalid payload length %s at byte %s' % (length, offset))
+        start = offset + _HEADER_SIZE
+        end = start + length
+        if end > size:
+            break
+        if zero_copy:
+            payload = _view(data, start, length)
+        else:
+            payload = data[start:end]
+        records.append((offset, sec, usec, payload))
+        offset = end
+    return records, offset
+
+def _truncated(data, offset, size, base=0):
+    """Builds the error for the incomplete record starting at data[offset:size]
+(base is the position of data within the file)."""
+    if size - offset < _HEADER_SIZE:
+        return TruncatedEntryError(base + offset, _HEADER_SIZE, size - offset)
+    length = _HEADER_STRUCT.unpack_from(data, offset)[2]
+    return TruncatedEntryError(base + offset, _HEADER_SIZE + length, size - offset)
+
+def _iter_mmap(fin, zero_copy=False):
+    """Reads all records by memory-mapping the file behind fin.
+Returns None if the stream can't be mapped."""
+    if is_compressed(fin):
+        return None
+    try:
+        fileno = fin.fileno()
+        start = fin.tell()
+        size = os.fstat(fileno).st_size
+        if size == 0:
+            return iter(())
+        data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    def gen():
+        try:
+            offset = start
+            while True:
+                #walk the map in windows so only a few records are held at a time
+                end = offset + _READ_CHUNK
+                if offset + _HEADER_SIZE <= size:
+                    #the window holds at least the next record
+                    end = max(end, offset + _HEADER_SIZE + _HEADER_STRUCT.unpack_from(data, offset)[2])
+                end = min(end, size)
+                records, offset = _parse_records(data, offset, end, zero_copy)
+                for record in records:
+                    yield record
+                if end == size:
+                    break
+            if offset < size:
+                raise _truncated(data, offset, size)
+        finally:
+            #zero-copy payloads still point into the map, let them keep it alive.
+            if not zero_copy:
+                data.close()
+    return gen()
+
+def _iter_chunked(fin, zero_copy=False, chunk_size=_READ_CHUNK, wait=None):
+    """Reads all records from fin in large blocks.
+
+:param wait: function called when the end of the stream is reached, if it returns True reading
+    is retried (for files still being written)."""
+    try:
+        base = fin.tell()
+    except (AttributeError, IOError):
+        base = 0
+    data = ''
+    missing = chunk_size
+    while True:
+        more = fin.read(missing)
+        if not more:
+            if wait is not None and wait():
+                continue
+            if data:
+                raise _truncated(data, 0, len(data), base)
+            break
+        data += more
+        records, offset = _parse_records(data, 0, len(data), zero_copy)
+        for record in records:
+            yield (base + record[0],) + record[1:]
+        base += offset
+        data = data[offset:]
+        missing = chunk_size
+        if len(data) >= _HEADER_SIZE:
+            missing = max(missing, _HEADER_SIZE + _HEADER_STRUCT.unpack_from(data)[2] - len(data))
+
+def iter_records(fin, use_mmap=True, zero_copy=False, wait=None):
+    """Iterates over the raw records of a ttyrec stream.
+
+:param fin: binary stream positioned at the start of a record.
+:param use_mmap: map the whole file in memory if possible instead of reading it in chunks.
+:param zero_copy: yield payloads as read-only views into the read buffer instead of strings.
+:param wait: function called at the end of the stream, reading continues if it returns True
+    (see :class:`ttyrec.follow.FileWatcher`). The file is then read in chunks.
+:returns: generator of (byte offset, sec, usec, payload)
+:raises TruncatedEntryError: if the stream ends in the middle of a record."""
+    records = None
+    if use_mmap and wait is None:
+        records = _iter_mmap(fin, zero_copy)
+    if records is None:
+        records = _iter_chunked(fin, zero_copy, wait=wait)
+    return records
+
+TMP_SUFFIX = '.tmp'
+"Suffix of files being written (they are renamed when complete)."
+
+def expand_path(path):
+    """Expands variables and user home and returns the absolute path."""
+    return os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
+
+def find_recordings(patterns):
+    """:param patterns: glob patterns (expanded with :func:`expand_path`).
+:returns: sorted list of the files matching any pattern, without the frame indexes,
+    keyframes and files being written that are stored next to the recordings."""
+    #avoid circular imports
+    from ttyrec.index import INDEX_SUFFIX
+    from ttyrec.vt import KEYFRAMES_SUFFIX
+    skipped = (INDEX_SUFFIX, KEYFRAMES_SUFFIX, TMP_SUFFIX)
+    return sorted(set(path for pattern in patterns for path in glob(expand_path(pattern))
+                      if os.path.isfile(path) and not path.endswith(skipped)))
+
+class AtomicFile(object):
+    """Writes a file through a temporary one next to it (see :data:`TMP_SUFFIX`) that replaces
+it once completely written, so readers (also in other processes) never see half a file.
+If anything fails the temporary file is removed and the original is left untouched."""
+    def __init__(self, path, mode='wb', compression=None):
+        """
+:param path: path of the file to write.
+:param mode: mode for opening the temporary file.
+:param compression: see :func:`open_compressed`."""
+        self.path = expand_path(path)
+        self.tmp_path = '%s.%s%s' % (self.path, os.getpid(), TMP_SUFFIX)
+        self.stream = open_compressed(self.tmp_path, mode, compression)
+    def __enter__(self):
+        return self.stream
+    def __exit__(self, exc_type, value, traceback):
+        try:
+            self.stream.close()
+            if exc_type is None:
+                os.rename(self.tmp_path, self.path)
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+class Sidecar(object):
+    """Data derived from a recording and stored next to it (its path plus :attr:`SUFFIX`).
+The stored data is used as long as the size and modification time of the recording (and the
+settings it was built with) are unchanged, otherwise it is built again.
+
+Subclasses set :attr:`SUFFIX`, the ``size`` and ``mtime`` of the recording they were built
+from, and implement ``build(tty_file, **settings)``, ``load(path)`` and ``dump(fout)``."""
+    SUFFIX = None
+    "Appended to the path of the recording."
+    KIND = 'sidecar'
+    "Name used in log messages."
+
+    @classmethod
+    def sidecar_path(cls, tty_file):
+        """:returns: the path where the data of tty_file is stored."""
+        return expand_path(tty_file) + cls.SUFFIX
+
+    def is_valid_for(self, tty_file, **settings):
+        """:returns: if the data still matches the given file and was built with the given
+    settings (attributes of the same name)."""
+        stat = os.stat(expand_path(tty_file))
+        if (stat.st_size, stat.st_mtime) != (self.size, self.mtime):
+            return False
+        return all(getattr(self, name) == value for name, value in settings.iteritems())
+
+    def save(self, path):
+        """Stores the data (replacing atomically any previous one)."""
+        with AtomicFile(path) as fout:
+            self.dump(fout)
+
+    @classmethod
+    def for_file(cls, tty_file, save=True, **settings):
+        """Returns the data of the given file, building it if it isn't stored or is outdated.
+
+:param save: store the data next to the file if it had to be built.
+:param settings: passed to ``build``."""
+        path = cls.sidecar_path(tty_file)
+        try:
+            stored = cls.load(path)
+            if stored.is_valid_for(tty_file, **settings):
+                return stored
+        except (IOError, OSError, TTYrecError) as e:
+            log.debug('Rebuilding %s %s: %s', cls.KIND, path, e)
+        built = cls.build(tty_file, **settings)
+        if save:
+            try:
+                built.save(path)
+            except (IOError, OSError) as e:
+                log.debug('Could not store %s %s: %s', cls.KIND, path, e)
+        return built
+
+def _records_in_range(records, start=None, end=None):
+    """Filters the records recorded between start and end seconds from the first one."""
+    first = None
+    for record in records:
+        tstamp = record[1] + record[2] / 1000000.0
+        if first is None:
+            first = tstamp
+        if end is not None and tstamp - first >= end:
+            break
+        if start and tstamp - first < start:
+            continue
+        yield record
+
+_WRITE_BUFFER = 1024 * 1024
+"Bytes collected before writing them to the output."
+
+_SCATTER_PARTS = 1024
+"Headers and payloads collected before writing them when scattering."
+
+class TTYrecWriter(object):
+    """Writes ttyrec entries in large blocks. The headers are packed into a reusable buffer and
+the time is accumulated in integer microseconds so the timestamps are exact however long the
+recording is."""
+    def __init__(self, fout, start=0, buffer_size=_WRITE_BUFFER, scatter=False):
+        """
+:param fout: binary output stream.
+:param start: microseconds since epoch of the first entry.
+:param buffer_size: bytes collected before writing them.
+:param scatter: hand headers and payloads to fout.writelines instead of copying them into
+    the buffer (faster for many small entries)."""
+        self.fout = fout
+        self.time = start
+        self.buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._pos = 0
+        self._parts = None
+        if scatter:
+            self._parts = []
+            self._parts_size = 0
+
+    def write(self, duration, payload):
+        """Appends an entry.
+
+:param duration: seconds since the previous entry.
+:param payload: data of the entry."""
+        self.time += int(round(duration * 1000000))
+        sec, usec = divmod(self.time, 1000000)
+        length = len(payload)
+        if self._parts is not None:
+            self._parts.append(_HEADER_STRUCT.pack(sec, usec, length))
+            self._parts.append(payload)
+            self._parts_size += _HEADER_SIZE + length
+            if len(self._parts) >= _SCATTER_PARTS or self._parts_size >= self.buffer_size:
+                self.flush()
+            return
+        end = self._pos + _HEADER_SIZE + length
+        if end > self.buffer_size:
+            self.flush()
+            end = _HEADER_SIZE + length
+            if end > self.buffer_size:
+                #doesn't fit, don't copy it around
+                self.fout.write(_HEADER_STRUCT.pack(sec, usec, length))
+                self.fout.write(payload)
+                return
+        _HEADER_STRUCT.pack_into(self._buffer, self._pos, sec, usec, length)
+        self._buffer[self._pos + _HEADER_SIZE:end] = payload
+        self._pos = end
+
+    def flush(self):
+        """Writes everything that is buffered."""
+        if self._parts:
+            self.fout.writelines(self._parts)
+            self._parts = []
+            self._parts_size = 0
+        if self._pos:
+            self.fout.write(_view(self._buffer, 0, self._pos))
+            self._pos = 0
+
+class ASCIIParseError(TTYrecError):
+    """An entry of an ascii representation can't be parsed."""
+    def __init__(self, message, entry_nr, line_nr, line=None):
+        """
+:param message: what went wrong.
+:param entry_nr: number of the entry (starting at 1).
+:param line_nr: line where the entry starts (starting at 1).
+:param line: the header line of the entry."""
+        TTYrecError.__init__(self, 'Error in entry %s (line %s): %s: %r' % (entry_nr, line_nr, message, line))
+        self.entry_nr = entry_nr
+        self.line_nr = line_nr
+        self.line = line
+
+def iter_ascii(fin, lenient=False, chunk_size=_READ_CHUNK):
+    """Parses the ascii representation in large blocks.
+
+:param fin: binary stream with the ascii representation.
+:param lenient: skip corrupted entries (looking for the next valid header line) instead of
+    raising :class:`ASCIIParseError`.
+:returns: generator of (duration, payload, options string or None)"""
+    data = fin.read(chunk_size)
+    size = len(data)
+    eof = not data
+    pos = 0
+    entry_nr = 1
+    #lines before data (lines are only counted for reporting errors)
+    line_base = 1
+    head_match = _ASCII_ENTRY_HEAD.match
+    while True:
+        #fast path: the whole entry is in the buffer
+        m = head_match(data, pos)
+        if m is not None:
+            timing, length, options = m.groups()
+            start = m.end()
+            end = start + int(length)
+            if end < size and data[end] == '\n':
+                try:
+                    timing = float(timing)
+                except ValueError:
+                    pass
+                else:
+                    yield timing, data[start:end], options
+                    entry_nr += 1
+                    pos = end + 1
+                    continue
+
+        #slow path: get more data, finish or report the error
+        newline = data.find('\n', pos)
+        if newline < 0:
+            message = 'header without newline'
+        elif m is None:
+            message = 'invalid header'
+        elif end >= size or data[end] != '\n':
+            #There should be a carriage return separating each entry
+            message = 'payload of %s bytes is not followed by a newline' % length
+        else:
+            message = 'invalid duration'
+        #only an incomplete header line or payload can be fixed by reading more
+        if (newline < 0 or m is not None and end >= size) and not eof:
+            missing = chunk_size
+            if m is not None:
+                missing = max(chunk_size, end + 1 - size)
+            more = fin.read(missing)
+            eof = not more
+            line_base += data.count('\n', 0, pos)
+            data = data[pos:] + more
+            size = len(data)
+            pos = 0
+            continue
+        if pos >= size:
+            break
+
+        error = ASCIIParseError(message, entry_nr, line_base + data.count('\n', 0, pos),
+                                data[pos:newline if newline >= 0 else size])
+        if not lenient:
+            raise error
+        log.warning('%s', error)
+        if newline < 0:
+            break
+        pos = newline + 1
+
+_COMPRESSION_MAGIC = (('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz'),
+                      ('\x28\xb5\x2f\xfd', 'zstd'))
+"First bytes of the supported compressed formats."
+
+_COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.lzma': 'xz', '.zst': 'zstd'}
+"Compression used when writing to files with these extensions."
+
+_COMPRESS_LEVEL = 6
+"Trade some compression for speed."
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        #python 2
+        from backports import lzma
+    return lzma
+
+def _compressed_types():
+    """:returns: the classes of the streams opened by :func:`open_compressed`."""
+    import gzip
+    import bz2
+    types = [gzip.GzipFile, bz2.BZ2File]
+    try:
+        types.append(_lzma().LZMAFile)
+    except ImportError:
+        pass
+    return tuple(types)
+
+def is_compressed(stream):
+    """:returns: if the stream (de)compresses what it reads or writes, i.e. its file descriptor
+    can't be used directly."""
+    return isinstance(stream, _compressed_types())
+
+def detect_compression(path, mode='rb'):
+    """:returns: the compression of the given file (None if it's not compressed). Existing files
+    are recognized by their first bytes, new ones (i.e. if writing) by their extension."""
+    if 'r' in mode:
+        with open(path, 'rb') as fin:
+            magic = fin.read(6)
+        for prefix, compression in _COMPRESSION_MAGIC:
+            if magic.startswith(prefix):
+                return compression
+        return None
+    return _COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+def open_compressed(path, mode='rb', compression=None):
+    """Opens the given file (de)compressing it on the fly.
+
+:param compression: gzip, bz2, xz or zstd (xz requires lzma, or backports.lzma in python 2,
+    zstd requires the zstandard package). None opens the file as it is.
+:returns: file-like object."""
+    if compression is None:
+        return open(path, mode)
+    if compression == 'gzip':
+        import gzip
+        return gzip.GzipFile(path, mode, compresslevel=_COMPRESS_LEVEL)
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(path, mode, _READ_CHUNK, compresslevel=_COMPRESS_LEVEL)
+    if compression == 'xz':
+        return _lzma().LZMAFile(path, mode)
+    if compression == 'zstd':
+        import zstandard
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_size=_READ_CHUNK)
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+    raise TTYrecError('Unknown compression %s' % compression)
+
 class Stream(object):
     """Handle any string pointing to a path or any other similar object and close
-only if required (i.e. if it was opened here)"""
-    def __init__(self, path, *opts):
+only if required (i.e. if it was opened here).
+Paths to compressed files (gzip, bz2, xz or zstd) are transparently (de)compressed, see
+:func:`detect_compression`."""
+    def __init__(self, path, mode='r', compression='auto'):
+        """
+:param path: path or file-like object (which is used as it is).
+:param mode: mode for opening the path.
+:param compression: 'auto' for detecting it, None for none or see :func:`open_compressed`."""
         if isinstance(path, basestring):
-            path = os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
-            self.stream = open(path, *opts)
+            path = expand_path(path)
+            if compression == 'auto':
+                compression = detect_compression(path, mode)
+            self.stream = open_compressed(path, mode, compression)
             self.closeOnExit = True
         else:
             #don't close anything it wasn't opened here.
@@ -110,27 +907,158 @@ only if required (i.e. if it was opened here)"""
             self.stream.close()
 
 class TTYrecEntry(object):
-    def __init__(self, duration, payload, options = None):
+    """One frame of a recording.
+Entries are small (no instance dictionary) and only allocate their :class:`Options` when
+they are first used. Options given to several entries (e.g. when an effect splits one entry)
+are shared until they are changed through :attr:`options` of one of them, then that entry
+gets its own copy."""
+    __slots__ = ('duration', 'payload', 'timestamp', '_options')
+
+    def __init__(self, duration, payload, options = None, timestamp = None):
+        """
+:param duration: seconds to wait before displaying this entry.
+:param payload: data to display.
+:param options: :class:`Options` of this entry.
+:param timestamp: seconds since epoch when it was recorded (None if unknown)."""
         self.duration = duration
         self.payload = payload
+        self.timestamp = timestamp
+        self._options = None
         if options:
             self.options = options
-        else:
-            self.options = Options()
+
+    @property
+    def options(self):
+        """:class:`Options` of this entry, they can be changed without affecting other entries."""
+        options = self._options
+        if options is None:
+            options = self._options = Options()
+            options._owners = 1
+        elif options._owners > 1:
+            #copy on write
+            options._owners -= 1
+            options = self._options = Options(options)
+            options._owners = 1
+        return options
+
+    @options.setter
+    def options(self, options):
+        if not options:
+            self._options = None
+            return
+        if not isinstance(options, Options):
+            options = Options(options)
+        options._owners += 1
+        self._options = options
+
+    @property
+    def has_options(self):
+        return bool(self._options)
+
+    def has_option(self, key):
+        """:returns: if key is in the options (without allocating them)."""
+        return self._options is not None and key in self._options
+
+    def get_option(self, key, default=None):
+        """:returns: the value of the option key or default (without allocating or copying the options)."""
+        if self._options is None:
+            return default
+        return self._options.get(key, default)
+
+    def _options_str(self):
+        return str(self._options) if self._options else ''
+
     def __str__(self):
         if len(self.payload) > 10:
             payload = repr(self.payload[:11]) + '...'
         else:
             payload = self.payload
-        return '[%s] %s %s\n%s\n' % (self.duration, len(self.payload), self.options, payload)
+        return '[%s] %s %s\n%s\n' % (self.duration, len(self.payload), self._options_str(), payload)
 
     def __repr__(self):
-        return '[%s] %s %s\n%s\n' % (self.duration, len(self.payload), self.options, self.payload)
+        return '[%s] %s %s\n%s\n' % (self.duration, len(self.payload), self._options_str(), self.payload)
         
+def _native_str(value):
+    """json returns unicode but payloads are byte strings."""
+    if isinstance(value, basestring) and not isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+def _as_stream(source):
+    """:returns: source if it's a :class:`TTYrecStream` or the stream loading the ttyrec file at source."""
+    if isinstance(source, TTYrecStream):
+        return source
+    return TTYrecStream().load_ttyrec(source)
+
+class Stage(object):
+    """One step of the process pipe of a :class:`TTYrecStream`."""
+    def __init__(self, name, factory, args, source=False):
+        """
+:param name: name of the :class:`TTYrecStream` method that created it.
+:param factory: function returning the generator of this stage. It gets the generator of the
+    previous stage as only argument, unless this stage is a source.
+:param args: arguments of the method call.
+:param source: if this stage starts the pipe (i.e. it's a loader)."""
+        self.name = name
+        self.factory = factory
+        self.args = args
+        self.source = source
+
+    def to_dict(self):
+        return {'name': self.name, 'args': self.args}
+
+    def __repr__(self):
+        return '%s(%s)' % (self.name, ', '.join('%s=%r' % item for item in sorted(self.args.items())))
+
+class StageStats(object):
+    """What went through one stage of an instrumented :class:`TTYrecStream`
+(see :meth:`TTYrecStream.instrument`)."""
+    __slots__ = ('name', 'frames', 'bytes', 'duration', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.bytes = 0
+        #seconds of recording
+        self.duration = 0.0
+        #seconds spent getting the entries, including the previous stages
+        self.seconds = 0.0
+
+    def count(self, gen):
+        """:returns: generator of the entries of gen, counting them."""
+        next_entry = iter(gen).next
+        while True:
+            start = default_timer()
+            try:
+                entry = next_entry()
+            finally:
+                self.seconds += default_timer() - start
+            self.frames += 1
+            self.bytes += len(entry.payload)
+            self.duration += entry.duration
+            yield entry
+
+def _stats_summary(counters):
+    """:returns: list of dictionaries with the input, output and time of every stage."""
+    stages = []
+    previous = None
+    for counter in counters:
+        stage = {'name': counter.name, 'frames_out': counter.frames, 'bytes_out': counter.bytes,
+                 'duration_out': counter.duration, 'seconds': counter.seconds,
+                 'frames_in': 0, 'bytes_in': 0, 'duration_in': 0.0}
+        if previous is not None:
+            stage.update(frames_in=previous.frames, bytes_in=previous.bytes, duration_in=previous.duration,
+                         seconds=max(0.0, counter.seconds - previous.seconds))
+        stages.append(stage)
+        previous = counter
+    return stages
+
 class TTYrecStream(object):
     """This objects encapsulates all handling of ttyrec files and their ascii representation.
 It works also as a generator so you can iterate the results as may times as required.
-The operations applied are stored and reapplied every time the generator is run.
+The operations applied are stored as :class:`Stage` objects and the whole chain of
+generators is set up again every time the stream is iterated. The stored plan can be
+exported (:meth:`plan`, :meth:`to_json`) and applied to other streams (:meth:`apply_plan`).
 This means that no access is being done until required, each element is accessed only once
 and on demand.
 All methods return the object itself to easy concatenation. This is an example::
@@ -154,135 +1082,366 @@ There is no buffer strategy in place besides the default system stratgegy for ha
 defining this would be very simple. 
 """
     def __init__(self):
-        """Prepare the process pipe and the empty generator"""
-        self._process_pipe = []
-        self._gen = None
-
-    def __store(self):
-        """Store the method being called for re-play."""
-        frame = currentframe(1)
-        arg_spec = getargvalues(frame)
-        name = frame.f_code.co_name
-        args = {}
-        for var_name in arg_spec[0] + list(arg_spec[1:3]):
-            if var_name and var_name != 'self':
-                args[var_name] = arg_spec.locals[var_name]
-        self._process_pipe.append((name, args))
+        """Prepare the empty process pipe"""
+        self._stages = []
+        self._plan = None
+        self._instrumented = False
+        self._callback = None
+        self._stats = None
+
+    def _set_source(self, name, factory, **args):
+        """Starts a new pipe reading from the generator returned by factory()."""
+        self._stages = [Stage(name, factory, args, source=True)]
+        self._plan = None
         return self
-    
-    def __reload(self):
-        """Reloads the configuration to setup the generator again."""
-        proc_pipe = self._process_pipe
-        self._process_pipe = []
-        for method, args in proc_pipe:
-            getattr(self,method)(**args)
+
+    def _add_stage(self, name, factory, **args):
+        """Appends the generator returned by factory(old_generator) to the pipe."""
+        self._stages.append(Stage(name, factory, args))
+        self._plan = None
+        return self
+
+    def _compile(self):
+        """Builds (once) the function setting up the whole generator chain."""
+        if self._plan is None:
+            stages = [(stage.factory, stage.source) for stage in self._stages]
+            def plan():
+                gen = None
+                for factory, source in stages:
+                    if source:
+                        gen = factory()
+                    else:
+                        gen = factory(gen)
+                return gen
+            if self._instrumented:
+                plan = self._instrumented_plan()
+            self._plan = plan
+        return self._plan
+
+    def _instrumented_plan(self):
+        """:returns: a plan counting what goes through every stage (see :meth:`instrument`)."""
+        stages = [(stage.name, stage.factory, stage.source) for stage in self._stages]
+        def plan():
+            gen = None
+            counters = []
+            for name, factory, source in stages:
+                if source:
+                    gen = factory()
+                else:
+                    gen = factory(gen)
+                counter = StageStats(name)
+                counters.append(counter)
+                gen = counter.count(gen)
+            return self._report(gen, counters)
+        return plan
+
+    def _report(self, gen, counters):
+        """Passes all entries of gen and stores the statistics when it's done (or abandoned)."""
+        try:
+            for entry in gen:
+                yield entry
+        finally:
+            stats = {'stages': _stats_summary(counters),
+                     'seconds': counters[-1].seconds if counters else 0.0}
+            self._stats = stats
+            for stage in stats['stages']:
+                log.debug('%(name)s: %(frames_in)s -> %(frames_out)s frames, %(bytes_in)s -> %(bytes_out)s bytes, '
+                          '%(duration_in).3f -> %(duration_out).3fs of recording in %(seconds).3fs', stage)
+            if self._callback is not None:
+                self._callback(stats)
+
+    def instrument(self, enabled=True, callback=None):
+        """Counts the frames, bytes and seconds of recording that go in and out of every stage
+and the time spent in each of them (without the previous stages), every time the stream
+is iterated. Instrumentation slows down the stream a little, so it's off by default.
+The numbers are logged (debug level) at the end of every iteration.
+
+:param enabled: False turns the instrumentation off.
+:param callback: function called with the :meth:`stats` at the end of every iteration
+    (e.g. to feed them to a metrics system).
+:returns: This object"""
+        self._instrumented = enabled
+        self._callback = callback
+        self._plan = None
+        return self
+
+    def cached(self, cache=None):
+        """Processes the whole stream once and stores the result on disk, later calls (also
+from other processes) with the same plan and unchanged input files just read the stored
+result. See :mod:`ttyrec.cache`.
+
+:param cache: :class:`ttyrec.cache.ResultCache` to use (by default the one at ~/.cache/ttyrec).
+:returns: a new :class:`TTYrecStream` reading the stored result.
+:raises ValueError: if the stream can't be cached (e.g. it doesn't read files or uses functions)."""
+        #avoid circular import
+        from ttyrec.cache import default_cache
+        if cache is None:
+            cache = default_cache()
+        return cache.load(self)
+
+    def stats(self):
+        """:returns: statistics of the last iteration of an instrumented stream (None if there
+    wasn't any): a dictionary with 'seconds' (total) and 'stages', a list with a dictionary
+    for every stage with its 'name', 'frames_in', 'frames_out', 'bytes_in', 'bytes_out',
+    'duration_in', 'duration_out' (seconds of recording) and 'seconds' spent in it."""
+        return self._stats
 
     def __iter__(self):
-        """Returns the setup iterator and prepare a new one"""
-        it = self._gen
-        self.__reload()
-        return it
-    
-    def load_ttyrec(self, tty_file):
+        """Returns a new iterator running the whole pipe"""
+        return iter(self._compile()())
+
+    @property
+    def stages(self):
+        """The :class:`Stage` objects of this pipe in order."""
+        return tuple(self._stages)
+
+    def plan(self):
+        """:returns: the pipe as a list of dictionaries (name and arguments of each stage)."""
+        return [stage.to_dict() for stage in self._stages]
+
+    def to_json(self, **json_args):
+        """:returns: the pipe as json. Stages with arguments that can't be serialized (e.g.
+    file objects or functions) raise a TypeError."""
+        return json.dumps(self.plan(), **json_args)
+
+    def apply_plan(self, plan):
+        """Appends the stages of a plan to this pipe.
+
+:param plan: list of dictionaries as returned by :meth:`plan` or a json string of them.
+:returns: This object"""
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        for stage in plan:
+            args = dict((str(key), _native_str(value)) for key, value in stage.get('args', {}).items())
+            getattr(self, stage['name'])(**args)
+        return self
+
+    @staticmethod
+    def from_plan(plan):
+        """:returns: a new :class:`TTYrecStream` with the given plan (see :meth:`apply_plan`)."""
+        return TTYrecStream().apply_plan(plan)
+
+    def load_ttyrec(self, tty_file, use_mmap=True, zero_copy=False, lenient=False, start=None, end=None,
+                    follow=False, idle_timeout=None):
         """Reads a ttyrec binary file.
 
 :param tty_file: ttyrecord binary input file.
+:param use_mmap: memory-map the file instead of reading it in large chunks (only possible
+    for real files, other streams are always read in chunks).
+:param zero_copy: payloads are read-only views into the read buffer instead of strings.
+    Effects modifying the payload (e.g. :meth:`merge_lines`) require strings.
+:param lenient: if the last entry is truncated log a warning instead of raising
+    :class:`TruncatedEntryError`.
+:param start: skip all entries recorded before this many seconds from the beginning.
+:param end: stop at the first entry recorded this many seconds (or more) from the beginning.
+    If tty_file is a path both are resolved through the :class:`ttyrec.index.FrameIndex`
+    instead of reading the whole file.
+:param follow: the file is still being written (e.g. by ttyrec), wait for new entries at its end
+    instead of stopping (tty_file must be a path).
+:param idle_timeout: if following, stop after this many seconds without changes (None for
+    waiting for ever).
 :returns: This object"""
         def gen():
-            with Stream(tty_file, 'rb') as fin:
+            watcher = None
+            if follow:
+                from ttyrec.follow import FileWatcher
+                #the watch must be there before reading so no change is missed
+                watcher = FileWatcher(expand_path(tty_file))
+                #python 2 files don't read any further once they got to the end
+                stream = Stream(io.open(expand_path(tty_file), 'rb'))
+                stream.closeOnExit = True
+                wait = lambda: watcher.wait(idle_timeout)
+            else:
+                stream = Stream(tty_file, 'rb')
+                wait = None
+            with stream as fin:
                 last = None
                 try:
-                    while True:
-                        sec, usec, length = unpack(_HEADER, fin.read(_HEADER_SIZE))
-                        payload = fin.read(length)
-                        
-                        #ready
+                    if (start or end is not None) and isinstance(tty_file, basestring) and not follow:
+                        from ttyrec.index import FrameIndex
+                        index = FrameIndex.for_file(tty_file)
+                        first, stop = index.frame_range(start, end)
+                        if first >= stop:
+                            return
+                        fin.seek(index.offset(first))
+                        records = islice(iter_records(fin, use_mmap, zero_copy), stop - first)
+                    else:
+                        records = iter_records(fin, use_mmap, zero_copy, wait)
+                        if start or end is not None:
+                            records = _records_in_range(records, start, end)
+                    for _, sec, usec, payload in records:
                         tstamp = sec + usec / 1000000.0
                         if last is None:
                             last = tstamp
                         
-                        yield TTYrecEntry(tstamp-last, payload)
+                        yield TTYrecEntry(tstamp-last, payload, timestamp=tstamp)
                         last = tstamp
-                except:
-                    pass
-        self._gen = gen()
-        return self.__store()
+                except TruncatedEntryError as e:
+                    if not lenient:
+                        raise
+                    log.warning('%s: %s', tty_file, e)
+                finally:
+                    if watcher is not None:
+                        watcher.close()
+        return self._set_source('load_ttyrec', gen, tty_file=tty_file, use_mmap=use_mmap,
+                                zero_copy=zero_copy, lenient=lenient, start=start, end=end,
+                                follow=follow, idle_timeout=idle_timeout)
     
-    def load_ascii(self, ascii_file):
+    def load_concat(self, sources, max_gap=None):
+        """Reads several recordings one after the other (e.g. rotated recordings of a session).
+The first entry of each source waits as long as the time elapsed since the last entry of the
+previous source if both were recorded with timestamps (or as long as its own duration otherwise).
+
+:param sources: list of paths to ttyrec files or :class:`TTYrecStream` objects.
+:param max_gap: maximal seconds to wait between two sources (None for no limit).
+:returns: This object"""
+        streams = [_as_stream(source) for source in sources]
+        def gen():
+            last = None
+            for stream in streams:
+                first = True
+                for entry in stream:
+                    if first:
+                        first = False
+                        if last is not None and entry.timestamp is not None and entry.timestamp >= last:
+                            entry.duration = entry.timestamp - last
+                        if max_gap is not None and entry.duration > max_gap:
+                            entry.duration = max_gap
+                    if entry.timestamp is not None:
+                        last = entry.timestamp
+                    yield entry
+        return self._set_source('load_concat', gen, sources=list(sources), max_gap=max_gap)
+
+    def load_merge(self, sources):
+        """Interleaves several recordings by time (e.g. multiple panes recorded at once).
+Entries are ordered by their timestamp, entries without one (e.g. read from ascii) by the
+seconds elapsed since the beginning of their source. Only one entry per source is held at
+any time.
+
+:param sources: list of paths to ttyrec files or :class:`TTYrecStream` objects.
+:returns: This object"""
+        streams = [_as_stream(source) for source in sources]
+        def timed(nr, stream):
+            elapsed = 0.0
+            for seq, entry in enumerate(stream):
+                elapsed += entry.duration
+                tstamp = entry.timestamp if entry.timestamp is not None else elapsed
+                #nr and seq keep the order stable and entries from being compared
+                yield tstamp, nr, seq, entry
+        def gen():
+            last = None
+            for tstamp, _, _, entry in heapq.merge(*[timed(nr, stream) for nr, stream in enumerate(streams)]):
+                if last is None:
+                    entry.duration = 0.0
+                else:
+                    entry.duration = max(0.0, tstamp - last)
+                last = tstamp if last is None else max(last, tstamp)
+                yield entry
+        return self._set_source('load_merge', gen, sources=list(sources))
+
+    @staticmethod
+    def concat(*sources, **options):
+        """:returns: a new :class:`TTYrecStream` reading all sources one after the other
+    (see :meth:`load_concat`)."""
+        return TTYrecStream().load_concat(sources, **options)
+
+    @staticmethod
+    def merge(*sources):
+        """:returns: a new :class:`TTYrecStream` interleaving all sources by time
+    (see :meth:`load_merge`)."""
+        return TTYrecStream().load_merge(sources)
+
+    def load_table(self, table):
+        """Reads the entries stored in a table.
+
+:param table: :class:`ttyrec.table.TTYrecTable` instance.
+:returns: This object"""
+        def gen():
+            for entry in table.entries():
+                yield entry
+        return self._set_source('load_table', gen, table=table)
+
+    def slice(self, start=0, end=None):
+        """Restricts the loaded recording to the entries recorded between start (inclusive)
+and end (exclusive) seconds from its beginning. The first entry kept has no delay.
+Must be called right after :meth:`load_ttyrec`, the entries outside the range aren't read at
+all (see :class:`ttyrec.index.FrameIndex`).
+
+:param start: seconds from the beginning of the recording.
+:param end: seconds from the beginning of the recording or None for reading until the end.
+:returns: This object"""
+        if not self._stages or self._stages[-1].name != 'load_ttyrec':
+            raise TTYrecError('slice and seek_time can only be applied directly to load_ttyrec')
+        args = dict(self._stages[-1].args, start=start, end=end)
+        return self.load_ttyrec(**args)
+
+    def seek_time(self, tstamp):
+        """Starts the loaded recording at the given time (see :meth:`slice`).
+
+:param tstamp: seconds from the beginning of the recording.
+:returns: This object"""
+        return self.slice(tstamp, None)
+
+    def load_ascii(self, ascii_file, lenient=False):
         """Reads an ascii file representing a ttyrec binary.
 
 :param ascii_file: ascii input file.
+:param lenient: skip (and log) corrupted entries instead of raising :class:`ASCIIParseError`.
 :returns: This object"""
         def gen():
-            entry_nr=0
-            line_nr=0
-            with Stream(ascii_file, 'r') as fin:
-                try:
-                    while True:
-                        line = fin.readline()
-                        entry_nr += 1
-                        line_nr += 1
-                        if not line: break
-                        
-                        #get strings
-                        timing, length, options = _ASCII_HEAD.match(line).groups()
-                        #parse values
-                        timing = float(timing)
-                        length = int(length)
-                        if options:
-                            options = Options.from_str(options)
-                        
-                        payload = fin.read(length)
-                        line_nr += payload.count('\n')
-                            
-                        yield TTYrecEntry(timing, payload, options)
-                        assert(fin.read(1)=='\n') #There should be a carriage return separating each entry
-                        line_nr +=1
-                except:
-                    print "Error in entry %s (line~%s): %s" % (entry_nr, line_nr, line)
-                    raise
-        self._gen = gen()
-        return self.__store()
+            with Stream(ascii_file, 'rb') as fin:
+                for timing, payload, options in iter_ascii(fin, lenient):
+                    if options:
+                        options = Options.from_str(options)
+                    yield TTYrecEntry(timing, payload, options)
+        return self._set_source('load_ascii', gen, ascii_file=ascii_file, lenient=lenient)
     
     def save_ascii(self, ascii_file):
         """Writes result to an ascii file.
 
 :param ascii_file: ascii output file.
     """
-        with Stream(ascii_file, 'w') as fout:
-            for entry in self._gen:
+        with Stream(ascii_file, 'wb') as fout:
+            parts = []
+            size = 0
+            for entry in self:
                 #allow some simple time manipulation
-                fout.write('[%s] %s %s\n%s\n' % (entry.duration, len(entry.payload), entry.options, entry.payload))
+                part = '[%s] %s %s\n%s\n' % (entry.duration, len(entry.payload), entry._options_str(), entry.payload)
+                parts.append(part)
+                size += len(part)
+                if size >= _WRITE_BUFFER:
+                    fout.write(''.join(parts))
+                    parts = []
+                    size = 0
+            fout.write(''.join(parts))
             
-        #we have consumed the iterator, set it up again
-        self.__reload()
         return self
         
-    def save_ttyrec(self, tty_file):
+    def save_ttyrec(self, tty_file, scatter=False):
         """Writes result to a ttyrec binary file that can be replayed with ttyplay.
         
-:param tty_file: ttyrecord binary output file."""
-        runtime = 0.0
+:param tty_file: ttyrecord binary output file.
+:param scatter: write headers and payloads without copying them into a buffer
+    (see :class:`TTYrecWriter`)."""
         with Stream(tty_file , 'wb') as fout:
-            for entry in self._gen:
-                length = len(entry.payload)
-                runtime += entry.duration
-                sec = int(runtime)
-                usec = int((runtime-int(runtime)) * 1000000)
-                header = pack(_HEADER, sec, usec, length)
-                
-                fout.write(header)
-                fout.write(entry.payload)
+            writer = None
+            for entry in self:
+                if writer is None:
+                    #keep the original time if known
+                    start = 0
+                    if entry.timestamp is not None:
+                        start = int(round(entry.timestamp * 1000000)) - int(round(entry.duration * 1000000))
+                    writer = TTYrecWriter(fout, start, scatter=scatter)
+                writer.write(entry.duration, entry.payload)
+            if writer is not None:
+                writer.flush()
                 
-        #we have consumed the iterator, set it up again
-        self.__reload()
         return self
         
     #EFFECTS
     def teletype(self):
         from random import Random
-        r = Random(0)
-        def jitter_func(duration, jitter=None, max_delay=None, cap_to_max=True):
+        def jitter_func(r, duration, jitter=None, max_delay=None, cap_to_max=True):
             if max_delay is None: max_delay = 2 * duration
             if duration >= max_delay: return max_delay
             if jitter is None: jitter=0.02
@@ -294,24 +1453,25 @@ defining this would be very simple.
             
             
         def gen(old_generator):
+            #every run must produce the same jitter
+            r = Random(0)
             for entry in old_generator:
-                if 'i' in entry.options and len(entry.payload) > 1:
-                    char_duration = entry.options['i']
+                if entry.has_option('i') and len(entry.payload) > 1:
+                    char_duration = entry.get_option('i')
                     if char_duration is None: char_duration = 0.1
                     else: char_duration = float(char_duration)
-                    jitter = entry.options.get('j', None)
+                    jitter = entry.get_option('j')
                     if jitter is not None: jitter = float(jitter)
                     
                     #this is input we must extend it in a typewritter similar manner
                     for c in entry.payload:
-                        duration = jitter_func(char_duration, jitter)
-                        #should we copy the options? Does it make sense?
-                        yield TTYrecEntry(duration, c, entry.options)
+                        duration = jitter_func(r, char_duration, jitter)
+                        #the options are shared until one of the entries changes them
+                        yield TTYrecEntry(duration, c, entry._options)
                 else:
                     yield entry
 
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('teletype', gen)
 
     def cap_delays(self, max_delay=3):
         """Reduces all delay to the given maximum.
@@ -323,8 +1483,7 @@ defining this would be very simple.
                     entry.duration = max_delay
                 
                 yield entry  
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('cap_delays', gen, max_delay=max_delay)
     
     def change_speed(self, speed=1.0):
         """changes the recorded speed to the given one.
@@ -334,8 +1493,7 @@ defining this would be very simple.
             for entry in old_generator:
                     entry.duration *= speed
                     yield entry
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('change_speed', gen, speed=speed)
     
     def add_intro(self, intro_delay=1):
         """Clears the screen before starting and remain like that for a while.
@@ -351,8 +1509,7 @@ defining this would be very simple.
                     yield TTYrecEntry(intro_delay, clear_screen)
                     
                 yield entry
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('add_intro', gen, intro_delay=intro_delay)
     
     def split_lines(self, delay_per_line=0.01):
         """Break lines stored and show them with some delay, line by line.
@@ -361,9 +1518,8 @@ defining this would be very simple.
         def gen(old_generator):
             for entry in old_generator:
                 for line in entry.payload.splitlines(True):
-                    yield TTYrecEntry(delay_per_line, line, entry.options)
-        self._gen = gen(self._gen)
-        return self.__store()
+                    yield TTYrecEntry(delay_per_line, line, entry._options)
+        return self._add_stage('split_lines', gen, delay_per_line=delay_per_line)
     
     def delay_input(self, delay_before_input=0, delay_after_input=1):
         """Adds some delay before and/or after the input is done.
@@ -373,7 +1529,7 @@ defining this would be very simple.
         def gen(old_generator):
             in_input = False
             for entry in old_generator:
-                if 'i' in entry.options:
+                if entry.has_option('i'):
                     if not in_input:
                         entry.duration = delay_before_input
                         in_input = True
@@ -382,39 +1538,177 @@ defining this would be very simple.
                     entry.duration = delay_after_input 
                     in_input = False
                 yield entry
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('delay_input', gen, delay_before_input=delay_before_input,
+                               delay_after_input=delay_after_input)
     
     def raw_effect(self, func=None):
-        if func is not None:
-            def gen(old_generator):
-                for entry in old_generator:
-                    yield func(entry)
-        self._gen = gen(self._gen)
-        return self.__store()
+        def gen(old_generator):
+            for entry in old_generator:
+                if func is not None:
+                    entry = func(entry)
+                yield entry
+        return self._add_stage('raw_effect', gen, func=func)
     
+    def minimize_redraws(self, quantum=0.05, rows=24, cols=80):
+        """Shrinks the output of full screen programs, which repaint everything all the time.
+All output within quantum seconds is shown at once, as the original output or as the
+minimal redraw of the cells that changed (see :class:`ttyrec.vt.ScreenDiff`), whatever is
+shorter. Entries that don't change the screen are dropped (their delay goes to the next one).
+The screen looks the same at the time of every entry left. Redraws keep titles, bells and
+cursor visibility, but not what the screen model doesn't know (e.g. mouse modes). Options
+are lost.
+
+:param quantum: seconds of output shown together (0 for only dropping redundant entries).
+:param rows: rows of the recorded terminal.
+:param cols: columns of the recorded terminal."""
+        def gen(old_generator):
+            from ttyrec.vt import Screen, ScreenDiff, PASSTHROUGH, HIDDEN_STATE
+            screen = Screen(rows, cols)
+            diff = ScreenDiff(rows, cols)
+            #the redraws don't leave the terminal waiting to wrap at the last column, the model may
+            wrap_pending = [False]
+
+            def show(raw, wrap_before):
+                """:returns: the data changing the terminal from its last state to the screen."""
+                redraw = diff.update(screen)
+                original = ''.join(raw)
+                if not redraw:
+                    return ''.join(PASSTHROUGH.findall(original))
+                #escape sequences cut at either end would be parsed differently after a redraw
+                if (len(original) <= len(redraw) and wrap_before == wrap_pending[0] and not raw[0]
+                        and not screen._partial and not HIDDEN_STATE.search(original)):
+                    wrap_pending[0] = screen.wrap_pending
+                    return original
+                wrap_pending[0] = False
+                return redraw + ''.join(PASSTHROUGH.findall(original))
+
+            #the original output of the group, starting with the escape sequence cut before it
+            raw = []
+            wrap_before = False
+            group_start = None
+            time = 0.0
+            last_time = 0.0
+            last_shown = 0.0
+            timestamp = None
+            for entry in old_generator:
+                time += entry.duration
+                if group_start is not None and time - group_start >= quantum:
+                    data = show(raw, wrap_before)
+                    if data:
+                        yield TTYrecEntry(last_time - last_shown, data, timestamp=timestamp)
+                        last_shown = last_time
+                    group_start = None
+                if group_start is None:
+                    group_start = time
+                    raw = [screen._partial]
+                    wrap_before = screen.wrap_pending
+                screen.feed(entry.payload)
+                raw.append(entry.payload)
+                last_time = time
+                timestamp = entry.timestamp
+            if group_start is not None:
+                data = show(raw, wrap_before)
+                if data:
+                    yield TTYrecEntry(last_time - last_shown, data, timestamp=timestamp)
+        return self._add_stage('minimize_redraws', gen, quantum=quantum, rows=rows, cols=cols)
+
+    def batch_effect(self, func, block_size=BLOCK_SIZE):
+        """Applies func to blocks of entries joined in one buffer (see :class:`Block`), e.g.
+to run a regular expression over all of them at once::
+
+    def remove_bells(block):
+        block.sub('\\x07', '')
+        return block.split()
+
+    stream.batch_effect(remove_bells)
+
+:param func: function getting a :class:`Block` and returning the entries to pass on
+    (usually :meth:`Block.split` after changing the block). Entries held back with
+    :meth:`Block.hold` are given again in the next block, or in a last one of their own.
+:param block_size: payload bytes joined in every block (see :func:`blocks`), matches
+    spanning two blocks aren't seen unless they are held back."""
+        def apply(old_generator):
+            held = []
+            pos = 0
+            for block in blocks(old_generator, block_size):
+                if held:
+                    block = Block(held + block.entries, pos=pos)
+                yield func(block)
+                held, pos = _held(block)
+            if held:
+                yield func(Block(held, pos=pos, last=True))
+        def gen(old_generator):
+            return chain.from_iterable(apply(old_generator))
+        return self._add_stage('batch_effect', gen, func=func, block_size=block_size)
+
+    def window_effect(self, func, lookback=1, lookahead=0):
+        """Applies func to every entry seeing the ones around it.
+
+:param func: function getting a :class:`Window` (``window[0]`` is the current entry,
+    ``window[-1]`` the previous one, ``window[1]`` the next one...) and returning the entry
+    to pass on or None to drop it.
+:param lookback: number of previous entries available.
+:param lookahead: number of following entries available."""
+        def gen(old_generator):
+            for window in windowed(old_generator, lookback, lookahead):
+                entry = func(window)
+                if entry is not None:
+                    yield entry
+        return self._add_stage('window_effect', gen, func=func, lookback=lookback, lookahead=lookahead)
+
+    def prefetch(self, size=1024):
+        """Runs all previous stages in a background thread, reading up to size entries in
+advance. Useful to overlap reading (e.g. from network filesystems or compressed files) with
+the following stages and writing.
+
+:param size: maximal number of entries read in advance."""
+        def gen(old_generator):
+            return prefetched(old_generator, size)
+        return self._add_stage('prefetch', gen, size=size)
+
     def effect(self, generator):
-        self._gen = generator(self._gen)
-        return self.__store()
+        return self._add_stage('effect', generator, generator=generator)
     
-    def merge_lines(self, threshold=0.01, merge_input=False):
-        """Merge lines with less than threshold seconds pause together."""
+    def merge_lines(self, threshold=0.01, merge_input=False, max_size=None, max_duration=None):
+        """Merge lines with less than threshold seconds pause together.
+
+:param threshold: seconds (or fraction) below which an entry is merged into the previous one.
+:param merge_input: merge also entries marked as input.
+:param max_size: maximal payload bytes of a merged entry (None for no limit).
+:param max_duration: maximal seconds of output shown at once by a merged entry, i.e. the
+    pauses merged into it (None for no limit)."""
         def gen(old_generator):
             last_entry = None
+            #payloads are joined only once per merged entry
+            parts = []
+            size = 0
+            #pauses merged into last_entry (not the one before it)
+            merged = 0
             for entry in old_generator:
                 if last_entry:
-                    if entry.duration < threshold and ('i' not in entry.options or merge_input):
+                    if entry.duration < threshold and (merge_input or not entry.has_option('i')) \
+                            and (max_size is None or size + len(entry.payload) <= max_size) \
+                            and (max_duration is None or merged + entry.duration <= max_duration):
                         #we preserve the options from the first entry
                         last_entry.duration += entry.duration
-                        last_entry.payload += entry.payload
+                        merged += entry.duration
+                        parts.append(entry.payload)
+                        size += len(entry.payload)
                         continue
+                    if len(parts) > 1:
+                        last_entry.payload = ''.join(parts)
                     yield last_entry
                 last_entry = entry
+                parts = [entry.payload]
+                size = len(entry.payload)
+                merged = 0
             #send the last entry
             if last_entry is not None:
+                if len(parts) > 1:
+                    last_entry.payload = ''.join(parts)
                 yield last_entry
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('merge_lines', gen, threshold=threshold, merge_input=merge_input,
+                               max_size=max_size, max_duration=max_duration)
     
     def mark_input(self, prompt_suffix=' $ '):
         """Mark lines following what is defined to be the end of the prompt as input 
@@ -424,79 +1718,329 @@ defining this would be very simple.
             for entry in old_generator:
                 if next_is_input:
                     next_is_input = False
-                    if 'i' not in entry.options: entry.options.add('i')
+                    if not entry.has_option('i'): entry.options.add('i')
                 elif entry.payload.endswith(prompt_suffix):
                     next_is_input = True
                 yield entry
-        self._gen = gen(self._gen)
-        return self.__store()
+        return self._add_stage('mark_input', gen, prompt_suffix=prompt_suffix)
         
         
 from time import sleep
+import time
 import curses
 import sys
+import ctypes
+import ctypes.util
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+#CLOCK_MONOTONIC of the platforms whose value is known
+_CLOCK_MONOTONIC = (('linux', 1), ('darwin', 6), ('freebsd', 4))
+
+def _monotonic_clock():
+    """:returns: time.monotonic (python 3), clock_gettime(CLOCK_MONOTONIC) through ctypes or, if
+    neither is available, time.time (which jumps with the system clock)."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    clock_ids = [clock_id for platform, clock_id in _CLOCK_MONOTONIC if sys.platform.startswith(platform)]
+    if not clock_ids:
+        return time.time
+    clock_gettime = None
+    #old C libraries have it in librt
+    for name in ('c', 'rt'):
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    if clock_gettime is None:
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    clock_id = clock_ids[0]
+    def monotonic():
+        spec = _timespec()
+        if clock_gettime(clock_id, ctypes.byref(spec)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    try:
+        monotonic()
+    except OSError as e:
+        log.debug('No monotonic clock: %s', e)
+        return time.time
+    return monotonic
+
+_clock = _monotonic_clock()
+"Monotonic clock if available (see :func:`_monotonic_clock`)."
+
+_KEY_POLL_INTERVAL = 0.05
+"Maximal seconds between checks for user input while waiting for the next entry."
+
+_REFRESH = 1.0 / 60
+"Default seconds between writes when playing at maximal speed."
+
+_MAX_PENDING = 64 * 1024
+"Maximal bytes held back while playing behind schedule before writing them anyway."
+
+class PlaybackClock(object):
+    """Maps the time within a recording to the wall clock time at which it must be shown.
+All deadlines are absolute so delays in writing or sleeping don't accumulate."""
+    def __init__(self, speed=1.0, clock=_clock):
+        self.clock = clock
+        self.speed = speed
+        self.reset(0.0)
+
+    def now(self):
+        return self.clock()
+
+    def reset(self, position):
+        """Starts counting from now, which corresponds to position seconds of the recording."""
+        self._base_wall = self.clock()
+        self._base_position = position
+
+    def position(self):
+        """:returns: the seconds of the recording that should be displayed now."""
+        return self._base_position + (self.clock() - self._base_wall) * self.speed
+
+    def set_speed(self, speed):
+        """Changes the speed from the current position onwards."""
+        self.reset(self.position())
+        self.speed = speed
+
+    def deadline(self, position):
+        """:returns: the wall clock time at which position seconds of the recording are due."""
+        return self._base_wall + (position - self._base_position) / self.speed
+
 class Player(object):
     def __init__(self, stream = None):
         if stream is None:
             stream = TTYrecStream()
         self._stream = stream
+        self.stats = {}
+        self.keyframe_interval = 10.0
+        self._keyframes = None
         
     def load(self, tty_file):
         self._stream.load_ttyrec(tty_file)
-    
-    def play(self, speed=1.0, interactive=True):
+        self._keyframes = None
+
+    def _poll_keys(self, w, clock, seek_step=10):
+        """Consumes all pending key events (to avoid processing old signals).
+
+:returns: (False if the playback should stop, seconds to seek forward/backwards)."""
+        running = True
+        seek = 0
+        try:
+            while True:
+                key = w.getch()
+                if key == curses.ERR:
+                    #all events has been consumed
+                    break
+                if key == ord('q'):
+                    running=False
+                elif key in map(ord, 'p '):
+                    position = clock.position()
+                    w.nodelay(False)
+                    while True:
+                        key = w.getkey()
+                        if key in 'p ': 
+                            break
+                    w.nodelay(True)
+                    clock.reset(position)
+                elif key == ord('f'):
+                    if clock.speed < 10:
+                        clock.set_speed(clock.speed * 2.0)
+                elif key == ord('s'):
+                    if clock.speed > 0.01:
+                        clock.set_speed(clock.speed / 2.0)
+                elif key == ord('0'):
+                    clock.set_speed(0.5)
+                elif key >= ord('1') and key <= ord('9'):
+                    clock.set_speed(float(key - ord('0')))
+                elif key in (curses.KEY_RIGHT, ord('>')):
+                    seek += seek_step
+                elif key in (curses.KEY_LEFT, ord('<')):
+                    seek -= seek_step
+        except curses.error:
+            pass
+        return running, seek
+
+    def _seekable_file(self):
+        """:returns: the path of the played file if seeking is possible (i.e. the stream
+    just loads a whole ttyrec file) or None."""
+        stages = self._stream.stages
+        if len(stages) == 1 and stages[0].name == 'load_ttyrec':
+            args = stages[0].args
+            if isinstance(args.get('tty_file'), basestring) and not args.get('start') \
+                    and args.get('end') is None and not args.get('follow'):
+                return args['tty_file']
+        return None
+
+    def _seek(self, w, tty_file, tstamp):
+        """Shows the screen at the given time.
+
+:returns: generator of the entries following tstamp"""
+        from ttyrec.vt import Keyframes
+        if self._keyframes is None:
+            rows, cols = w.getmaxyx()
+            self._keyframes = Keyframes.for_file(tty_file, rows, cols, self.keyframe_interval)
+        screen, entries = self._keyframes.seek(tty_file, tstamp)
+        sys.stdout.write(screen.render())
+        sys.stdout.flush()
+        return entries
+
+    def _flush(self, pending, clock):
+        """Writes all pending entries at once and updates the drift statistics.
+
+:param pending: list of (deadline, payload) of the entries to be written."""
+        if not pending:
+            return
+        sys.stdout.write(''.join([payload for _, payload in pending]))
+        sys.stdout.flush()
+        now = self._last_flush = clock.now()
+        stats = self.stats
+        stats['writes'] += 1
+        stats['frames'] += len(pending)
+        for deadline, _ in pending:
+            late = max(0.0, now - deadline)
+            stats['total_late'] += late
+            if late > stats['max_late']:
+                stats['max_late'] = late
+        stats['last_late'] = max(0.0, now - pending[-1][0])
+        del pending[:]
+
+    def play(self, speed=1.0, interactive=True, refresh=None, max_speed=False, seek_step=10, start=0.0):
+        """Plays the stream on the terminal.
+Entries are scheduled at absolute deadlines, when running behind all due entries are written
+at once. Keys (if interactive): q quit, p/space pause, f faster, s slower, 1-9 speed and 0 half speed,
+left/right (or </>) seek seek_step seconds (only for streams just loading a ttyrec file, see
+:class:`ttyrec.vt.Keyframes`).
+
+:param speed: initial speed factor.
+:param interactive: react to key strokes.
+:param refresh: seconds (e.g. 1/60.0); all entries due within this interval are written
+    together so the number of writes depends on the playing time and not on the number of entries.
+:param max_speed: ignore all delays and write everything as fast as possible (e.g. for
+    verifying a recording). Output is still written in blocks of refresh seconds
+    (1/60 by default).
+:param seek_step: seconds to jump when seeking.
+:param start: seconds of the recording to skip. Streams that can't seek write everything
+    before start at once."""
+        if refresh is None:
+            refresh = _REFRESH if max_speed else 0.0
+        flush_interval = refresh or _KEY_POLL_INTERVAL
+        self.stats = stats = dict(frames=0, writes=0, total_late=0.0, max_late=0.0, last_late=0.0)
+        clock = PlaybackClock(speed)
+        self._last_flush = clock.now()
+        reader = None
         try:
             w = curses.initscr()
             w.nodelay(True)
+            w.keypad(True)
             curses.noecho()
-            start = datetime.now()
+            started = datetime.now()
             running_time = 0.0
             running = True
-            for entry in self._stream:
-                if interactive:
-                    try:
-                        while True:
-                            #we consume all events before proceeding
-                            #to avoid processing old signals
-                            key = w.getch()
-                            if key == curses.ERR:
-                                #all events has been consumed
+            seek = 0
+            pending = []
+            pending_size = 0
+            seekable_file = self._seekable_file()
+            entries = iter(self._stream)
+            if start > 0:
+                if seekable_file is not None:
+                    entries = self._seek(w, seekable_file, start)
+                    running_time = start
+                else:
+                    skipped = []
+                    for entry in entries:
+                        if running_time + entry.duration >= start:
+                            #it's played as usual
+                            entry.duration -= start - running_time
+                            entries = chain([entry], entries)
+                            break
+                        running_time += entry.duration
+                        skipped.append(entry.payload)
+                    sys.stdout.write(''.join(skipped))
+                    sys.stdout.flush()
+                    running_time = start
+            clock.reset(running_time)
+            #reading in the background lets keys and due entries be handled while the stream
+            #is slow (e.g. following a recording being written), it is replaced when seeking
+            reader = _Reader(entries)
+            while running:
+                try:
+                    entry = reader.get(flush_interval)
+                except Empty:
+                    self._flush(pending, clock)
+                    pending_size = 0
+                    if interactive:
+                        running, seek = self._poll_keys(w, clock, seek_step)
+                        if seek and seekable_file is not None:
+                            running_time = max(0.0, clock.position() + seek)
+                            reader.close()
+                            reader = _Reader(self._seek(w, seekable_file, running_time))
+                            clock.reset(running_time)
+                        seek = 0
+                    continue
+                if entry is None:
+                    break
+                running_time += entry.duration
+                now = clock.now()
+                if max_speed:
+                    deadline = now
+                else:
+                    deadline = clock.deadline(running_time)
+                #a batch takes everything that is due and whatever comes within refresh seconds
+                limit = now
+                if pending:
+                    limit = max(now, pending[0][0] + refresh)
+                if (deadline > limit or pending_size > _MAX_PENDING
+                        or now - self._last_flush > flush_interval):
+                    #show everything that is due before waiting
+                    self._flush(pending, clock)
+                    pending_size = 0
+                    while running:
+                        if interactive:
+                            running, seek = self._poll_keys(w, clock, seek_step)
+                            if seek and seekable_file is not None:
+                                running_time = max(0.0, clock.position() + seek)
+                                reader.close()
+                                reader = _Reader(self._seek(w, seekable_file, running_time))
+                                clock.reset(running_time)
                                 break
-                            if key == ord('q'):
-                                running=False
-                            elif key in map(ord, 'p '):
-                                w.nodelay(False)
-                                while True:
-                                    key = w.getkey()
-                                    if key in 'p ': 
-                                        break
-                                w.nodelay(True)
-                            elif key == ord('f'):
-                                if speed < 10:
-                                    speed *= 2.0
-                            elif key == ord('s'):
-                                if speed > 0.01:
-                                    speed /= 2.0
-                            elif key == ord('0'):
-                                speed = 0.5
-                            elif key >= ord('1') and key <= ord('9'):
-                                speed = float(key - ord('0'))
-                                
-                    except:
-                        pass
-                
+                        if max_speed:
+                            break
+                        deadline = clock.deadline(running_time)
+                        remaining = deadline - clock.now()
+                        if remaining <= 0:
+                            break
+                        if interactive:
+                            remaining = min(remaining, _KEY_POLL_INTERVAL)
+                        sleep(remaining)
                 if not running:
                     break
-                running_time += entry.duration
-                sleep(entry.duration / speed)
-                sys.stdout.write(entry.payload)
-                sys.stdout.flush() 
+                if seek and seekable_file is not None:
+                    #the current entry belongs to the old position
+                    seek = 0
+                    continue
+                pending.append((deadline, entry.payload))
+                pending_size += len(entry.payload)
+                if not refresh and not max_speed and deadline >= now:
+                    #on time, only late entries are written together
+                    self._flush(pending, clock)
+                    pending_size = 0
+            self._flush(pending, clock)
             recording_time=timedelta(seconds=running_time)
-            play_time=datetime.now() - start
+            play_time=datetime.now() - started
         finally:
+            if reader is not None:
+                reader.close()
             curses.endwin()
 
         print "Recording: %s" % recording_time
         print "Play time: %s" % play_time
-
-        
\ No newline at end of file
+        if stats['frames']:
+            print "Drift: %.3fs at the end, %.3fs max, %.3fs mean (%s entries in %s writes)" % (
+                    stats['last_late'], stats['max_late'], stats['total_late'] / stats['frames'],
+                    stats['frames'], stats['writes'])
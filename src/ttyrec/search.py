@@ -0,0 +1,269 @@
+"""Full text search over many recordings::
+
+    python -m ttyrec.search -d ~/recordings.db --index 'recordings/*'
+    python -m ttyrec.search -d ~/recordings.db 'rm -rf'
+
+The printed text of every recording (without escape sequences) is split in lines and stored
+in a sqlite database together with an index of the trigrams of each line. A query looks up
+the lines containing all trigrams of the searched text so it doesn't read any recording.
+Indexing again only reads the files that changed since they were indexed.
+
+Hits can be played from the matching time::
+
+    from ttyrec.search import SearchIndex
+    hit = SearchIndex('~/recordings.db').search('rm -rf')[0]
+    hit.play()
+"""
+import os
+import re
+import sys
+import sqlite3
+from optparse import OptionParser
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import TTYrecStream, Player, expand_path, find_recordings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, file INTEGER, frame INTEGER, time REAL, text TEXT);
+CREATE INDEX IF NOT EXISTS lines_file ON lines (file);
+CREATE TABLE IF NOT EXISTS grams (gram TEXT, line INTEGER, PRIMARY KEY (gram, line)) WITHOUT ROWID;
+"""
+
+#escape sequences (CSI, OSC and two character ones) and control characters except \b, \n and \r
+_CONTROL = re.compile(u'\x1b(?:\\[[?>!=]?[0-9;:]*[ -/]*[@-~]?|\\][^\x07\x1b]*(?:\x07|\x1b\\\\)?|[ -/]*.?)'
+                      u'|[\x00-\x07\x0b\x0c\x0e-\x1a\x1c-\x1f\x7f]')
+_LINE_BREAK = re.compile(u'\r\n?|\n')
+
+_GRAM = 3
+_MAX_LINE = 4096
+
+def _grams(text):
+    """:returns: set of the (lowercase) trigrams of text."""
+    text = text.lower()
+    return set(text[i:i + _GRAM] for i in xrange(len(text) - _GRAM + 1))
+
+def _backspace(text):
+    """:returns: text with the characters erased by backspaces removed (e.g. typing mistakes)."""
+    if u'\b' not in text:
+        return text
+    chars = []
+    for char in text:
+        if char == u'\b':
+            if chars:
+                chars.pop()
+        else:
+            chars.append(char)
+    return u''.join(chars)
+
+def text_lines(stream):
+    """Splits the printed text of a recording in lines.
+
+:param stream: iterable of :class:`ttyrec.io.TTYrecEntry`.
+:returns: generator of (number of the entry where the line starts, seconds since the start of
+    the recording, text) for every non blank line."""
+    parts = []
+    size = 0
+    start = None
+    time = 0.0
+    for frame, entry in enumerate(stream):
+        time += entry.duration
+        text = _CONTROL.sub(u'', entry.payload.decode('utf-8', 'replace'))
+        for nr, piece in enumerate(_LINE_BREAK.split(text)):
+            #a line also ends if it's too long (binary garbage or a screen redrawn without line breaks)
+            if parts and (nr or size > _MAX_LINE):
+                line = _backspace(u''.join(parts)).strip()
+                if line:
+                    yield start[0], start[1], line
+                parts = []
+                size = 0
+                start = None
+            if piece:
+                if start is None:
+                    start = (frame, time)
+                parts.append(piece)
+                size += len(piece)
+    if parts:
+        line = _backspace(u''.join(parts)).strip()
+        if line:
+            yield start[0], start[1], line
+
+class Hit(object):
+    """A line of a recording matching a query."""
+    def __init__(self, path, frame, time, text):
+        """
+:param path: path of the recording.
+:param frame: number of the entry where the line starts.
+:param time: seconds since the start of the recording.
+:param text: the whole line."""
+        self.path = path
+        self.frame = frame
+        self.time = time
+        self.text = text
+
+    def play(self, before=2.0, **options):
+        """Plays the recording from a little before the line was printed.
+
+:param before: seconds to start playing before the line.
+:param options: other arguments of :meth:`ttyrec.io.Player.play`."""
+        Player(TTYrecStream().load_ttyrec(self.path)).play(start=max(0.0, self.time - before), **options)
+
+    def __repr__(self):
+        return 'Hit(%r, frame=%s, time=%.3f, text=%r)' % (self.path, self.frame, self.time, self.text)
+
+class SearchIndex(object):
+    """sqlite database with the text of many recordings."""
+    def __init__(self, db_path):
+        """:param db_path: path of the database, created if it doesn't exist."""
+        self.db_path = expand_path(db_path)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+
+    def _remove(self, file_id):
+        db = self._db
+        db.execute('DELETE FROM grams WHERE line IN (SELECT id FROM lines WHERE file = ?)', (file_id,))
+        db.execute('DELETE FROM lines WHERE file = ?', (file_id,))
+        db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def add(self, tty_file, lenient=True):
+        """Indexes a recording unless it's indexed and didn't change since then.
+
+:param tty_file: path of the ttyrec file (may be compressed).
+:param lenient: index truncated recordings up to the last complete entry.
+:returns: if the file was (re)indexed."""
+        path = os.path.abspath(expand_path(tty_file))
+        stat = os.stat(path)
+        db = self._db
+        row = db.execute('SELECT id, size, mtime FROM files WHERE path = ?', (path.decode('utf-8'),)).fetchone()
+        if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime:
+            return False
+        with db:
+            if row is not None:
+                self._remove(row[0])
+            file_id = db.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                                 (path.decode('utf-8'), stat.st_size, stat.st_mtime)).lastrowid
+            for frame, time, text in text_lines(TTYrecStream().load_ttyrec(path, lenient=lenient)):
+                line_id = db.execute('INSERT INTO lines (file, frame, time, text) VALUES (?, ?, ?, ?)',
+                                     (file_id, frame, time, text)).lastrowid
+                db.executemany('INSERT INTO grams (gram, line) VALUES (?, ?)',
+                               [(gram, line_id) for gram in _grams(text)])
+        return True
+
+    def update(self, paths, report=None):
+        """Indexes all new or modified recordings and forgets the ones that don't exist anymore.
+
+:param paths: paths of the recordings.
+:param report: function called with (path, if it was indexed, error or None) for every path.
+:returns: number of indexed files."""
+        indexed = 0
+        for path in paths:
+            try:
+                changed = self.add(path)
+                error = None
+            except Exception as e:
+                changed = False
+                error = e
+                log.warning('Could not index %s: %s', path, e)
+            indexed += changed
+            if report is not None:
+                report(path, changed, error)
+        self.prune()
+        return indexed
+
+    def prune(self):
+        """Forgets the recordings that don't exist anymore."""
+        with self._db:
+            for file_id, path in self._db.execute('SELECT id, path FROM files').fetchall():
+                if not os.path.exists(path.encode('utf-8')):
+                    self._remove(file_id)
+
+    def files(self):
+        """:returns: list of the paths of the indexed recordings."""
+        return [path.encode('utf-8') for path, in self._db.execute('SELECT path FROM files ORDER BY path')]
+
+    def search(self, query, ignore_case=False, limit=None, path=None):
+        """Looks for the lines containing query.
+
+:param query: text to search (str in utf-8 or unicode).
+:param ignore_case: also find the text in other case.
+:param limit: maximal number of hits (None for all of them).
+:param path: only search this recording.
+:returns: list of :class:`Hit` sorted by path and time."""
+        if not isinstance(query, unicode):
+            query = query.decode('utf-8')
+        grams = sorted(_grams(query))
+        sql = 'SELECT files.path, lines.frame, lines.time, lines.text FROM lines JOIN files ON files.id = lines.file'
+        conditions = []
+        params = []
+        if grams:
+            conditions.append('lines.id IN (%s)' % ' INTERSECT '.join(
+                ['SELECT line FROM grams WHERE gram = ?'] * len(grams)))
+            params.extend(grams)
+        else:
+            #too short for the trigrams
+            conditions.append("lines.text LIKE ? ESCAPE '\\'")
+            params.append(u'%%%s%%' % re.sub(r'([%_\\])', r'\\\1', query))
+        if path is not None:
+            conditions.append('files.path = ?')
+            params.append(os.path.abspath(expand_path(path)).decode('utf-8'))
+        sql += ' WHERE %s ORDER BY files.path, lines.time' % ' AND '.join(conditions)
+        if ignore_case:
+            query = query.lower()
+        hits = []
+        for path, frame, time, text in self._db.execute(sql, params):
+            #the trigrams may be anywhere in the line and in any case
+            if query in (text.lower() if ignore_case else text):
+                hits.append(Hit(path.encode('utf-8'), frame, time, text))
+                if limit is not None and len(hits) >= limit:
+                    break
+        return hits
+
+def main(argv=None):
+    parser = OptionParser(prog='ttyrec-search', usage='%prog [options] -d DATABASE (--index GLOB... | QUERY)')
+    parser.add_option('-d', '--database', help='sqlite file with the index')
+    parser.add_option('--index', action='store_true', default=False,
+                      help='index the new and modified recordings matching the arguments')
+    parser.add_option('-i', '--ignore-case', action='store_true', default=False)
+    parser.add_option('-n', '--limit', type='int', default=None, help='maximal number of hits')
+    parser.add_option('-f', '--file', default=None, help='only search this recording')
+    parser.add_option('--play', type='int', default=None, metavar='N',
+                      help='play the recording of the N-th hit (starting at 1) from the match')
+    options, args = parser.parse_args(argv)
+    if not options.database or not args:
+        parser.error('database and a query (or the recordings to index) are required')
+
+    with SearchIndex(options.database) as index:
+        if options.index:
+            paths = find_recordings(args)
+            def report(path, changed, error):
+                if error is not None:
+                    print 'FAILED %s: %s' % (path, error)
+                elif changed:
+                    print 'indexed %s' % path
+            indexed = index.update(paths, report)
+            print 'Indexed %s files (%s up to date)' % (indexed, len(paths) - indexed)
+            return 0
+
+        hits = index.search(' '.join(args), options.ignore_case, options.limit, options.file)
+        if options.play is not None:
+            if not 0 < options.play <= len(hits):
+                print 'There are %s hits' % len(hits)
+                return 1
+            hits[options.play - 1].play()
+            return 0
+        for nr, hit in enumerate(hits):
+            print '%s) %s @%.2fs (frame %s): %s' % (nr + 1, hit.path, hit.time, hit.frame, hit.text.encode('utf-8'))
+    return 0 if hits else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,369 @@
+"""Plays a recording to many clients at once::
+
+    python -m ttyrec.server -p 8023 tutorial.tty
+    socat -,raw,echo=0 TCP:localhost:8023
+
+The recording is decoded once into a :class:`SharedRecording` (payloads, times and screen
+keyframes) that all clients share. Every client gets its own :class:`PlaybackSession` with
+its own position, speed and pause state, controlled with the same keys as
+:meth:`ttyrec.io.Player.play` (q, p/space, f, s, 0-9, left/right or </>).
+
+:class:`PlaybackSession` doesn't do any I/O: it says what has to be written now and how long
+to wait for the next write, so it can be driven by any event loop.
+:class:`PlaybackServer` drives all sessions from a single thread with ``select`` over TCP or
+unix sockets.
+"""
+import os
+import sys
+import errno
+import select
+import socket
+from array import array
+from bisect import bisect_right
+from optparse import OptionParser
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import TTYrecStream, PlaybackClock, expand_path
+from ttyrec.vt import Screen
+
+MAX_BUFFER = 1 << 20
+"Bytes a client may fall behind before it's disconnected."
+
+_SEEK_KEYS = (('\x1b[C', 1), ('\x1b[D', -1), ('\x1bOC', 1), ('\x1bOD', -1), ('>', 1), ('<', -1))
+
+class SharedRecording(object):
+    """Frames of a recording decoded once, with keyframes of the screen for seeking."""
+    def __init__(self, stream, rows=24, cols=80, keyframe_interval=10.0):
+        """
+:param stream: iterable of :class:`ttyrec.io.TTYrecEntry` (e.g. a :class:`ttyrec.io.TTYrecStream`).
+:param rows: rows of the screen used for seeking.
+:param cols: columns of the screen used for seeking.
+:param keyframe_interval: seconds between keyframes."""
+        self.rows = rows
+        self.cols = cols
+        self.keyframe_interval = keyframe_interval
+        self.times = array('d')
+        "seconds from the beginning at which every frame is shown"
+        self.payloads = []
+        position = 0.0
+        for entry in stream:
+            position += entry.duration
+            self.times.append(position)
+            self.payloads.append(entry.payload)
+        self._keyframes = None
+        self._keyframe_times = None
+
+    def __len__(self):
+        return len(self.payloads)
+
+    @property
+    def duration(self):
+        return self.times[-1] if self.times else 0.0
+
+    def frames_until(self, position, start=0):
+        """:returns: number of the first frame shown after position seconds (looking from start)."""
+        return bisect_right(self.times, position, start)
+
+    def _build_keyframes(self):
+        screen = Screen(self.rows, self.cols)
+        keyframes = []
+        next_time = 0.0
+        for nr, (tstamp, payload) in enumerate(zip(self.times, self.payloads)):
+            if tstamp >= next_time:
+                keyframes.append((tstamp, nr, screen.snapshot()))
+                next_time = tstamp + self.keyframe_interval
+            screen.feed(payload)
+        self._keyframes = keyframes
+        self._keyframe_times = [tstamp for tstamp, _, _ in keyframes]
+
+    def screen_at(self, position):
+        """Rebuilds the screen at the given time from the closest keyframe (built on the first call).
+
+:returns: (data redrawing the whole screen, number of the first frame after position)."""
+        if self._keyframes is None:
+            self._build_keyframes()
+        screen = Screen(self.rows, self.cols)
+        end = self.frames_until(position)
+        index = bisect_right(self._keyframe_times, position) - 1
+        start = 0
+        if index >= 0:
+            _, start, snapshot = self._keyframes[index]
+            screen.restore(snapshot)
+        for payload in self.payloads[start:end]:
+            screen.feed(payload)
+        return screen.render(), end
+
+class PlaybackSession(object):
+    """Position, speed and pause state of one viewer of a :class:`SharedRecording`.
+Call :meth:`update` whenever the wait it returned is over (or a key was handled) and write
+what it returns::
+
+    session = PlaybackSession(recording)
+    while not session.finished:
+        data, wait = session.update()
+        write(data)
+        sleep_or_wait_for_keys(wait)
+"""
+    def __init__(self, recording, speed=1.0, seek_step=10, clock=None):
+        """
+:param recording: the :class:`SharedRecording` to play.
+:param speed: initial speed factor.
+:param seek_step: seconds to jump when seeking.
+:param clock: :class:`ttyrec.io.PlaybackClock` (for tests or a shared time source)."""
+        self.recording = recording
+        self.seek_step = seek_step
+        self.clock = clock if clock is not None else PlaybackClock(speed)
+        self.clock.reset(0.0)
+        self.next_frame = 0
+        self.stopped = False
+        self._paused_at = None
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    @property
+    def finished(self):
+        return self.stopped or self.next_frame >= len(self.recording)
+
+    def position(self):
+        """:returns: seconds of the recording shown now."""
+        if self._paused_at is not None:
+            return self._paused_at
+        return self.clock.position()
+
+    def update(self):
+        """:returns: (data due now, seconds until the next frame is due or None if there is
+    nothing to wait for, i.e. paused or finished)."""
+        if self.finished:
+            return '', None
+        recording = self.recording
+        if self._paused_at is not None:
+            return '', None
+        end = recording.frames_until(self.clock.position(), self.next_frame)
+        data = ''.join(recording.payloads[self.next_frame:end])
+        self.next_frame = end
+        if end >= len(recording):
+            return data, None
+        return data, max(0.0, self.clock.deadline(recording.times[end]) - self.clock.now())
+
+    def pause(self):
+        if self._paused_at is None:
+            self._paused_at = self.clock.position()
+
+    def resume(self):
+        if self._paused_at is not None:
+            self.clock.reset(self._paused_at)
+            self._paused_at = None
+
+    def set_speed(self, speed):
+        self.clock.set_speed(speed)
+
+    def seek(self, position):
+        """Jumps to position seconds of the recording.
+
+:returns: data redrawing the screen at that time."""
+        position = min(max(0.0, position), self.recording.duration)
+        data, self.next_frame = self.recording.screen_at(position)
+        if self._paused_at is not None:
+            self._paused_at = position
+        self.clock.reset(position)
+        return data
+
+    def handle_input(self, data):
+        """Reacts to the keys pressed by the viewer (see :meth:`ttyrec.io.Player.play`).
+
+:returns: data to be written (the redrawn screen if seeking)."""
+        output = []
+        seek = 0
+        while data:
+            for sequence, direction in _SEEK_KEYS:
+                if data.startswith(sequence):
+                    seek += direction * self.seek_step
+                    data = data[len(sequence):]
+                    break
+            else:
+                key, data = data[0], data[1:]
+                if key in 'qQ\x03\x04':
+                    self.stopped = True
+                    break
+                elif key in 'p ':
+                    if self.paused:
+                        self.resume()
+                    else:
+                        self.pause()
+                elif key == 'f':
+                    if self.clock.speed < 10:
+                        self.set_speed(self.clock.speed * 2.0)
+                elif key == 's':
+                    if self.clock.speed > 0.01:
+                        self.set_speed(self.clock.speed / 2.0)
+                elif key == '0':
+                    self.set_speed(0.5)
+                elif '1' <= key <= '9':
+                    self.set_speed(float(key))
+        if seek:
+            output.append(self.seek(self.position() + seek))
+        return ''.join(output)
+
+class _Client(object):
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session
+        self.output = []
+        self.pending = 0
+        self.wait = 0.0
+
+    def queue(self, data):
+        if data:
+            self.output.append(data)
+            self.pending += len(data)
+
+    def send(self):
+        """Writes as much as possible without blocking.
+
+:returns: False if the connection was closed by the other end."""
+        if not self.output:
+            return True
+        data = ''.join(self.output)
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                sent = 0
+            else:
+                return False
+        data = data[sent:]
+        self.output = [data] if data else []
+        self.pending = len(data)
+        return True
+
+class PlaybackServer(object):
+    """Streams a :class:`SharedRecording` to every client that connects, each one with its own
+:class:`PlaybackSession`. Clients are disconnected when their playback is over."""
+    def __init__(self, recording, address, speed=1.0, max_buffer=MAX_BUFFER):
+        """
+:param recording: the :class:`SharedRecording` to play.
+:param address: (host, port) to listen on TCP or the path of a unix socket.
+:param speed: initial speed of every client.
+:param max_buffer: bytes a client may fall behind before it's disconnected."""
+        self.recording = recording
+        self.speed = speed
+        self.max_buffer = max_buffer
+        self.clients = {}
+        if isinstance(address, basestring):
+            address = expand_path(address)
+            if os.path.exists(address):
+                os.remove(address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+    def _accept(self):
+        try:
+            sock, peer = self.sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(False)
+        client = _Client(sock, PlaybackSession(self.recording, self.speed))
+        #start on a clean screen
+        client.queue('\x1b[H\x1b[2J')
+        self.clients[sock] = client
+        log.info('Client %s connected (%s clients)', peer or sock.fileno(), len(self.clients))
+
+    def _drop(self, client, reason):
+        del self.clients[client.sock]
+        client.sock.close()
+        log.info('Client %s disconnected: %s (%s clients)', client.sock, reason, len(self.clients))
+
+    def serve(self, timeout=None):
+        """Runs one round of the loop: waits for the next frame, a key or a new client.
+
+:param timeout: maximal seconds to wait (None for as long as needed)."""
+        waits = [client.wait for client in self.clients.itervalues() if client.wait is not None]
+        if timeout is not None:
+            waits.append(timeout)
+        wait = min(waits) if waits else None
+        writers = [sock for sock, client in self.clients.iteritems() if client.output]
+        try:
+            readable, writable, _ = select.select([self.sock] + self.clients.keys(), writers, [], wait)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for sock in readable:
+            if sock is self.sock:
+                self._accept()
+                continue
+            client = self.clients[sock]
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                data = ''
+            if not data:
+                self._drop(client, 'closed')
+                continue
+            client.queue(client.session.handle_input(data))
+        for client in self.clients.values():
+            session = client.session
+            data, client.wait = session.update()
+            client.queue(data)
+            if client.pending > self.max_buffer:
+                self._drop(client, 'too slow')
+            elif not client.send():
+                self._drop(client, 'write failed')
+            elif session.finished and not client.output:
+                self._drop(client, 'finished')
+
+    def serve_forever(self):
+        while True:
+            self.serve()
+
+    def close(self):
+        for client in self.clients.values():
+            self._drop(client, 'server closed')
+        self.sock.close()
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.remove(self.address)
+
+def main(argv=None):
+    parser = OptionParser(prog='ttyrec-server', usage='%prog [options] (-p PORT | -u SOCKET) FILE')
+    parser.add_option('-H', '--host', default='127.0.0.1', help='address to listen on (with --port)')
+    parser.add_option('-p', '--port', type='int', default=None, help='tcp port')
+    parser.add_option('-u', '--unix-socket', default=None, help='path of a unix socket')
+    parser.add_option('-i', '--input-format', choices=['ttyrec', 'ascii'], default='ttyrec')
+    parser.add_option('-s', '--speed', type='float', default=1.0, help='initial speed of every client')
+    parser.add_option('--rows', type='int', default=24, help='screen rows (for seeking)')
+    parser.add_option('--cols', type='int', default=80, help='screen columns (for seeking)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or (options.port is None) == (options.unix_socket is None):
+        parser.error('a recording and either a port or a unix socket are required')
+    logging.basicConfig(level=logging.INFO)
+
+    stream = TTYrecStream()
+    if options.input_format == 'ascii':
+        stream.load_ascii(args[0])
+    else:
+        stream.load_ttyrec(args[0])
+    recording = SharedRecording(stream, options.rows, options.cols)
+    address = options.unix_socket or (options.host, options.port)
+    server = PlaybackServer(recording, address, options.speed)
+    log.info('Serving %s (%s frames, %.1fs) on %s', args[0], len(recording), recording.duration, server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""Columnar representation of ttyrec recordings (requires numpy).
+
+Instead of one :class:`ttyrec.io.TTYrecEntry` per entry a :class:`TTYrecTable` holds the
+durations and the payload offsets and lengths in numpy arrays over a single payload buffer.
+The timing effects are applied to the whole recording at once::
+
+    from ttyrec.table import TTYrecTable
+
+    table = TTYrecTable.from_ttyrec('/tmp/a_file').cap_delays(2).change_speed(0.5)
+    table.to_stream().add_intro().save_ttyrec('/tmp/other_file')
+"""
+import numpy as np
+
+from ttyrec.io import (TTYrecStream, TTYrecEntry, Options, Stream, TruncatedEntryError,
+                       _HEADER_STRUCT, _HEADER_SIZE, _truncated)
+import logging
+log = logging.getLogger(__name__)
+
+class TTYrecTable(object):
+    """Whole recording stored as numpy arrays. The effects modify the table in place and
+return it for chaining them."""
+    def __init__(self, durations, offsets, lengths, payload, options=None):
+        """
+:param durations: seconds to wait before displaying each entry.
+:param offsets: start of the payload of each entry within payload.
+:param lengths: length of the payload of each entry.
+:param payload: buffer with the payloads of all entries.
+:param options: dictionary mapping entry numbers to their :class:`ttyrec.io.Options`
+    (entries without options are left out)."""
+        self.durations = np.asarray(durations, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.payload = payload
+        self.options = options if options is not None else {}
+
+    def __len__(self):
+        return len(self.durations)
+
+    @staticmethod
+    def from_stream(stream):
+        """Consumes any iterable of :class:`ttyrec.io.TTYrecEntry` (e.g. a
+:class:`ttyrec.io.TTYrecStream`).
+
+:returns: a new :class:`TTYrecTable` holding all entries."""
+        durations = []
+        lengths = []
+        parts = []
+        options = {}
+        for nr, entry in enumerate(stream):
+            durations.append(entry.duration)
+            lengths.append(len(entry.payload))
+            parts.append(entry.payload)
+            if entry.has_options:
+                options[nr] = Options(entry.options)
+        lengths = np.array(lengths, dtype=np.int64)
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        return TTYrecTable(durations, offsets, lengths, ''.join(parts), options)
+
+    @staticmethod
+    def from_ttyrec(tty_file, lenient=False):
+        """Reads a ttyrec binary file without creating any intermediate entry.
+The file content is used as payload buffer.
+
+:param tty_file: ttyrecord binary input file.
+:param lenient: if the last entry is truncated log a warning instead of raising
+    :class:`ttyrec.io.TruncatedEntryError`.
+:returns: a new :class:`TTYrecTable` holding all entries."""
+        with Stream(tty_file, 'rb') as fin:
+            data = fin.read()
+        unpack_from = _HEADER_STRUCT.unpack_from
+        headers = []
+        offset = 0
+        size = len(data)
+        while offset + _HEADER_SIZE <= size:
+            header = unpack_from(data, offset)
+            if offset + _HEADER_SIZE + header[2] > size:
+                break
+            headers.append(header)
+            offset += _HEADER_SIZE + header[2]
+        if offset < size:
+            error = _truncated(data, offset, size)
+            if not lenient:
+                raise error
+            log.warning('%s: %s', tty_file, error)
+
+        headers = np.array(headers, dtype=np.int64).reshape(-1, 3)
+        lengths = headers[:, 2]
+        #each payload comes after its own header and all previous entries
+        offsets = np.cumsum(lengths + _HEADER_SIZE) - lengths
+        tstamps = headers[:, 0] + headers[:, 1] / 1000000.0
+        durations = np.zeros(len(tstamps))
+        if len(tstamps):
+            durations[1:] = np.diff(tstamps)
+        return TTYrecTable(durations, offsets, lengths, data)
+
+    def entry(self, nr):
+        """:returns: the :class:`ttyrec.io.TTYrecEntry` at the given position."""
+        start = self.offsets[nr]
+        options = self.options.get(nr)
+        if options is not None:
+            #entries are mutable, don't let them change the table
+            options = Options(options)
+        return TTYrecEntry(float(self.durations[nr]), self.payload[start:start + self.lengths[nr]],
+                           options)
+
+    def entries(self):
+        """:returns: a generator of all entries as :class:`ttyrec.io.TTYrecEntry`."""
+        for nr in xrange(len(self)):
+            yield self.entry(nr)
+
+    def to_stream(self):
+        """:returns: a :class:`ttyrec.io.TTYrecStream` reading this table."""
+        return TTYrecStream().load_table(self)
+
+    def input_mask(self):
+        """:returns: boolean array marking the entries with input ('i' option)."""
+        mask = np.zeros(len(self), dtype=bool)
+        for nr, options in self.options.items():
+            if 'i' in options:
+                mask[nr] = True
+        return mask
+
+    def total_duration(self):
+        """:returns: seconds the recording takes."""
+        return float(self.durations.sum())
+
+    #EFFECTS
+    def cap_delays(self, max_delay=3):
+        """Same as :meth:`ttyrec.io.TTYrecStream.cap_delays`"""
+        np.minimum(self.durations, max_delay, out=self.durations)
+        return self
+
+    def change_speed(self, speed=1.0):
+        """Same as :meth:`ttyrec.io.TTYrecStream.change_speed`"""
+        self.durations *= speed
+        return self
+
+    def delay_input(self, delay_before_input=0, delay_after_input=1):
+        """Same as :meth:`ttyrec.io.TTYrecStream.delay_input`"""
+        mask = self.input_mask()
+        previous = np.zeros(len(mask), dtype=bool)
+        previous[1:] = mask[:-1]
+        self.durations[mask & ~previous] = delay_before_input
+        self.durations[~mask & previous] = delay_after_input
+        return self
@@ -0,0 +1,619 @@
+"""Lightweight VT100/xterm screen model.
+
+:class:`Screen` consumes the payloads of a recording and keeps the characters, attributes and
+cursor of the emulated terminal. Its state can be stored (:meth:`Screen.snapshot`) and turned
+back into the escape sequences reproducing it on a real terminal (:meth:`Screen.render`).
+
+:class:`Keyframes` stores snapshots taken periodically along a ttyrec file (cached next to it as
+``<file>.keyframes``) so the screen at any time can be rebuilt by restoring the closest
+previous snapshot and replaying only the entries after it::
+
+    from ttyrec.vt import Keyframes
+
+    keyframes = Keyframes.for_file('/tmp/a_file')
+    screen, entries = keyframes.seek('/tmp/a_file', 90*60)
+    print '\\n'.join(screen.text())
+"""
+import os
+import re
+import marshal
+from bisect import bisect_right
+import logging
+log = logging.getLogger(__name__)
+
+from ttyrec.io import Stream, Sidecar, TTYrecEntry, TTYrecError, TruncatedEntryError, iter_records, \
+    expand_path
+
+_TEXT = re.compile('[^\x00-\x1f\x1b\x7f]+')
+"Run of printable characters."
+
+_ESCAPE = re.compile(r'\x1b(?:\[([?>!=]?)([0-9;:]*)[ -/]*([@-~])|\][^\x07\x1b]*(?:\x07|\x1b\\)'
+                     r'|[()*+].|#.|([^\[\]()*+#]))')
+"Complete escape sequence: CSI (private marker, parameters, final), OSC, charset or other."
+
+_PARTIAL_ESCAPE = re.compile(r'\x1b(?:\[[?>!=]?[0-9;:]*[ -/]*|\][^\x07\x1b]*\x1b?|[()*+#])?\Z')
+"Escape sequence cut at the end of the data."
+
+_SGR_FLAGS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 7: 7, 8: 8, 9: 9}
+_SGR_CLEAR = {21: (1, 2), 22: (1, 2), 23: (3,), 24: (4,), 25: (5,), 27: (7,), 28: (8,), 29: (9,)}
+
+class Screen(object):
+    """Emulated terminal screen. Each cell holds a character and its attribute (the SGR
+parameters it was written with, '' being the default)."""
+    def __init__(self, rows=24, cols=80):
+        self.rows = rows
+        self.cols = cols
+        self.reset()
+
+    def reset(self):
+        """Clears the screen and all modes (like ESC c)."""
+        self.chars = [[' '] * self.cols for _ in xrange(self.rows)]
+        self.attrs = [[''] * self.cols for _ in xrange(self.rows)]
+        self.x = 0
+        self.y = 0
+        self.wrap_pending = False
+        self.top = 0
+        self.bottom = self.rows - 1
+        self.saved = (0, 0, (), '', '')
+        self.alternate = None
+        self._flags = ()
+        self._fg = ''
+        self._bg = ''
+        self.attr = ''
+        self._partial = ''
+
+    #STATE
+    def snapshot(self):
+        """:returns: the complete state as tuple of plain python types (see :meth:`restore`)."""
+        alternate = None
+        if self.alternate is not None:
+            alternate = ([list(row) for row in self.alternate[0]],
+                         [list(row) for row in self.alternate[1]]) + tuple(self.alternate[2:])
+        return ([list(row) for row in self.chars], [list(row) for row in self.attrs],
+                self.x, self.y, self.wrap_pending, self.top, self.bottom, self.saved, alternate,
+                self._flags, self._fg, self._bg, self._partial)
+
+    def restore(self, snapshot):
+        """Sets the state stored with :meth:`snapshot`."""
+        (chars, attrs, self.x, self.y, self.wrap_pending, self.top, self.bottom, saved, alternate,
+         flags, self._fg, self._bg, self._partial) = snapshot
+        self.chars = [list(row) for row in chars]
+        self.attrs = [list(row) for row in attrs]
+        self.rows = len(chars)
+        self.cols = len(chars[0]) if chars else 0
+        self.saved = tuple(saved)
+        self.alternate = None
+        if alternate is not None:
+            self.alternate = ([list(row) for row in alternate[0]],
+                              [list(row) for row in alternate[1]]) + tuple(alternate[2:])
+        self._flags = tuple(flags)
+        self._update_attr()
+
+    def text(self):
+        """:returns: the lines of the screen (without attributes)."""
+        return [''.join(row) for row in self.chars]
+
+    def render(self):
+        """:returns: the escape sequences that draw this screen on a real terminal."""
+        out = ['\x1b[r\x1b[0m\x1b[H\x1b[2J']
+        for y in xrange(self.rows):
+            out.append(self._render_cells(y, 0, self.cols))
+        if self.top != 0 or self.bottom != self.rows - 1:
+            out.append('\x1b[%s;%sr' % (self.top + 1, self.bottom + 1))
+        out.append('\x1b[%s;%sH' % (self.y + 1, self.x + 1))
+        out.append('\x1b[0;%sm' % self.attr if self.attr else '\x1b[0m')
+        out.append(self._partial)
+        return ''.join(out)
+
+    def _render_cells(self, y, start, end, skip_blanks=True):
+        """:returns: the escape sequences drawing the cells [start, end) of row y on a terminal
+    whose attributes are at the default. Trailing default blanks are skipped if skip_blanks."""
+        chars = self.chars[y]
+        attrs = self.attrs[y]
+        if skip_blanks:
+            while end > start and chars[end - 1] == ' ' and attrs[end - 1] == '':
+                end -= 1
+        if end <= start:
+            return ''
+        out = ['\x1b[%s;%sH' % (y + 1, start + 1)]
+        current = ''
+        for x in xrange(start, end):
+            attr = attrs[x]
+            if attr != current:
+                out.append('\x1b[0;%sm' % attr if attr else '\x1b[0m')
+                current = attr
+            out.append(chars[x])
+        if current:
+            out.append('\x1b[0m')
+        return ''.join(out)
+
+    #PARSING
+    def feed(self, data):
+        """Processes the given output. Escape sequences may be split between calls."""
+        if self._partial:
+            data = self._partial + str(data)
+            self._partial = ''
+        pos = 0
+        size = len(data)
+        text_match = _TEXT.match
+        while pos < size:
+            m = text_match(data, pos)
+            if m:
+                self._put_text(m.group())
+                pos = m.end()
+                continue
+            c = data[pos]
+            if c == '\x1b':
+                m = _ESCAPE.match(data, pos)
+                if m:
+                    self._escape(m)
+                    pos = m.end()
+                elif _PARTIAL_ESCAPE.match(data, pos):
+                    self._partial = data[pos:]
+                    return
+                else:
+                    #broken sequence, drop the escape
+                    pos += 1
+                continue
+            self._control(c)
+            pos += 1
+
+    def _put_text(self, text):
+        if '\x80' <= max(text):
+            #utf-8 continuation bytes belong to the previous character
+            parts = re.findall('[\x80-\xbf]+|[^\x80-\xbf]+', text)
+            for part in parts:
+                if '\x80' <= part[0] <= '\xbf':
+                    x, y = self.x, self.y
+                    if not self.wrap_pending:
+                        x -= 1
+                    if x >= 0:
+                        self.chars[y][x] += part
+                        continue
+                self._put_cells(part)
+        else:
+            self._put_cells(text)
+
+    def _put_cells(self, text):
+        cols = self.cols
+        attr = self.attr
+        while text:
+            if self.wrap_pending:
+                self.wrap_pending = False
+                self.x = 0
+                self._linefeed()
+            x = self.x
+            count = min(len(text), cols - x)
+            self.chars[self.y][x:x + count] = text[:count]
+            self.attrs[self.y][x:x + count] = [attr] * count
+            text = text[count:]
+            if x + count >= cols:
+                self.x = cols - 1
+                self.wrap_pending = True
+            else:
+                self.x = x + count
+
+    def _control(self, c):
+        if c in '\n\x0b\x0c':
+            self._linefeed()
+        elif c == '\r':
+            self.x = 0
+            self.wrap_pending = False
+        elif c == '\x08':
+            if self.x > 0:
+                self.x -= 1
+            self.wrap_pending = False
+        elif c == '\t':
+            self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+            self.wrap_pending = False
+        #the rest (bell, shift in/out, etc.) don't change the screen
+
+    def _linefeed(self):
+        self.wrap_pending = False
+        if self.y == self.bottom:
+            self._scroll_up(1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _reverse_index(self):
+        self.wrap_pending = False
+        if self.y == self.top:
+            self._scroll_down(1)
+        elif self.y > 0:
+            self.y -= 1
+
+    def _blank_row(self):
+        return [' '] * self.cols, [self._erase_attr()] * self.cols
+
+    def _erase_attr(self):
+        """Erased cells keep the background color only."""
+        if self._bg:
+            return self._bg
+        return ''
+
+    def _scroll_up(self, count, top=None):
+        top = self.top if top is None else top
+        count = min(count, self.bottom - top + 1)
+        for _ in xrange(count):
+            del self.chars[top]
+            del self.attrs[top]
+            chars, attrs = self._blank_row()
+            self.chars.insert(self.bottom, chars)
+            self.attrs.insert(self.bottom, attrs)
+
+    def _scroll_down(self, count, top=None):
+        top = self.top if top is None else top
+        count = min(count, self.bottom - top + 1)
+        for _ in xrange(count):
+            del self.chars[self.bottom]
+            del self.attrs[self.bottom]
+            chars, attrs = self._blank_row()
+            self.chars.insert(top, chars)
+            self.attrs.insert(top, attrs)
+
+    def _erase(self, y, start, end):
+        attr = self._erase_attr()
+        self.chars[y][start:end] = [' '] * (end - start)
+        self.attrs[y][start:end] = [attr] * (end - start)
+
+    def _escape(self, m):
+        final = m.group(3)
+        if final is not None:
+            params = [int(p) if p.isdigit() else 0 for p in m.group(2).replace(':', ';').split(';')]
+            self._csi(m.group(1), params, final)
+            return
+        other = m.group(4)
+        if other is None:
+            #OSC, charsets, etc.
+            return
+        if other == '7':
+            self._save_cursor()
+        elif other == '8':
+            self._restore_cursor()
+        elif other == 'D':
+            self._linefeed()
+        elif other == 'E':
+            self.x = 0
+            self._linefeed()
+        elif other == 'M':
+            self._reverse_index()
+        elif other == 'c':
+            self.reset()
+
+    def _save_cursor(self):
+        self.saved = (self.x, self.y, self._flags, self._fg, self._bg)
+
+    def _restore_cursor(self):
+        self.x, self.y, self._flags, self._fg, self._bg = self.saved
+        self.x = min(self.x, self.cols - 1)
+        self.y = min(self.y, self.rows - 1)
+        self.wrap_pending = False
+        self._update_attr()
+
+    def _csi(self, private, params, final):
+        n = params[0] or 1
+        if final != 'm':
+            self.wrap_pending = False
+        if private == '?':
+            if final in 'hl' and set(params) & set((47, 1047, 1049)):
+                self._alternate_screen(final == 'h')
+            return
+        if private:
+            return
+        if final == 'm':
+            self._sgr(params)
+        elif final in 'Hf':
+            row = params[0] or 1
+            col = (params[1] if len(params) > 1 else 0) or 1
+            self.y = min(row, self.rows) - 1
+            self.x = min(col, self.cols) - 1
+        elif final == 'A':
+            self.y = max(self.top if self.y >= self.top else 0, self.y - n)
+        elif final in 'Be':
+            self.y = min(self.bottom if self.y <= self.bottom else self.rows - 1, self.y + n)
+        elif final in 'Ca':
+            self.x = min(self.cols - 1, self.x + n)
+        elif final == 'D':
+            self.x = max(0, self.x - n)
+        elif final == 'E':
+            self.y = min(self.rows - 1, self.y + n)
+            self.x = 0
+        elif final == 'F':
+            self.y = max(0, self.y - n)
+            self.x = 0
+        elif final in 'G`':
+            self.x = min(n, self.cols) - 1
+        elif final == 'd':
+            self.y = min(n, self.rows) - 1
+        elif final == 'J':
+            mode = params[0]
+            if mode == 0:
+                self._erase(self.y, self.x, self.cols)
+                for y in xrange(self.y + 1, self.rows):
+                    self._erase(y, 0, self.cols)
+            elif mode == 1:
+                for y in xrange(self.y):
+                    self._erase(y, 0, self.cols)
+                self._erase(self.y, 0, self.x + 1)
+            else:
+                for y in xrange(self.rows):
+                    self._erase(y, 0, self.cols)
+        elif final == 'K':
+            mode = params[0]
+            if mode == 0:
+                self._erase(self.y, self.x, self.cols)
+            elif mode == 1:
+                self._erase(self.y, 0, self.x + 1)
+            else:
+                self._erase(self.y, 0, self.cols)
+        elif final in 'LM':
+            if self.top <= self.y <= self.bottom:
+                if final == 'L':
+                    self._scroll_down(n, self.y)
+                else:
+                    self._scroll_up(n, self.y)
+                self.x = 0
+        elif final == '@':
+            n = min(n, self.cols - self.x)
+            chars, attrs = self.chars[self.y], self.attrs[self.y]
+            chars[self.x:self.x] = [' '] * n
+            attrs[self.x:self.x] = [self._erase_attr()] * n
+            del chars[self.cols:]
+            del attrs[self.cols:]
+        elif final == 'P':
+            n = min(n, self.cols - self.x)
+            chars, attrs = self.chars[self.y], self.attrs[self.y]
+            del chars[self.x:self.x + n]
+            del attrs[self.x:self.x + n]
+            chars.extend([' '] * n)
+            attrs.extend([self._erase_attr()] * n)
+        elif final == 'X':
+            self._erase(self.y, self.x, min(self.cols, self.x + n))
+        elif final == 'S':
+            self._scroll_up(n)
+        elif final == 'T':
+            self._scroll_down(n)
+        elif final == 'r':
+            top = (params[0] or 1) - 1
+            bottom = (params[1] if len(params) > 1 else 0) or self.rows
+            if top < bottom - 1 and bottom <= self.rows:
+                self.top, self.bottom = top, bottom - 1
+                self.x, self.y = 0, 0
+        elif final == 's':
+            self._save_cursor()
+        elif final == 'u':
+            self._restore_cursor()
+
+    def _alternate_screen(self, enable):
+        if enable and self.alternate is None:
+            self.alternate = (self.chars, self.attrs, self.x, self.y)
+            self.chars = [[' '] * self.cols for _ in xrange(self.rows)]
+            self.attrs = [[''] * self.cols for _ in xrange(self.rows)]
+        elif not enable and self.alternate is not None:
+            self.chars, self.attrs, self.x, self.y = self.alternate
+            self.alternate = None
+
+    def _sgr(self, params):
+        flags = set(self._flags)
+        i = 0
+        while i < len(params):
+            p = params[i]
+            if p == 0:
+                flags.clear()
+                self._fg = self._bg = ''
+            elif p in _SGR_FLAGS:
+                flags.add(p)
+            elif p in _SGR_CLEAR:
+                flags.difference_update(_SGR_CLEAR[p])
+            elif 30 <= p <= 37 or 90 <= p <= 97:
+                self._fg = str(p)
+            elif p == 39:
+                self._fg = ''
+            elif 40 <= p <= 47 or 100 <= p <= 107:
+                self._bg = str(p)
+            elif p == 49:
+                self._bg = ''
+            elif p in (38, 48) and i + 1 < len(params):
+                #extended colors: 5;n or 2;r;g;b
+                count = 3 if params[i + 1] == 5 else 5
+                color = ';'.join(str(v) for v in params[i:i + count])
+                if p == 38:
+                    self._fg = color
+                else:
+                    self._bg = color
+                i += count - 1
+            i += 1
+        self._flags = tuple(sorted(flags))
+        self._update_attr()
+
+    def _update_attr(self):
+        self.attr = ';'.join([str(flag) for flag in self._flags] + [v for v in (self._fg, self._bg) if v])
+
+_GAP = 6
+"Unchanged cells between two changed ones that are rewritten instead of moving the cursor."
+
+PASSTHROUGH = re.compile(r'\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b\[\?25[hl]|\x07')
+"Output that doesn't change the cells but matters (titles, cursor visibility and bells)."
+
+HIDDEN_STATE = re.compile(r'\x1b(?:[78c]|\[[su]|\[\?[0-9;]*(?:47|1047|1049)[0-9;]*[hl])')
+"Output using or changing state that redrawing the cells doesn't reproduce (saved cursor, alternate screen)."
+
+class ScreenDiff(object):
+    """What a real terminal shows, to redraw only what changed on a :class:`Screen`."""
+    def __init__(self, rows=24, cols=80):
+        self.chars = [[' '] * cols for _ in xrange(rows)]
+        self.attrs = [[''] * cols for _ in xrange(rows)]
+        self.region = (0, rows - 1)
+        self.cursor = (0, 0)
+        self.attr = ''
+
+    def _full(self, screen):
+        """:returns: the data redrawing the whole screen (:meth:`Screen.render` without the
+    cut escape sequence at the end, which doesn't belong to the drawing)."""
+        data = screen.render()
+        if screen._partial:
+            data = data[:-len(screen._partial)]
+        return data
+
+    def update(self, screen):
+        """:returns: the escape sequences turning the terminal from the last state into screen
+    ('' if it looks the same) using cursor moves and the changed cells only, or the whole
+    screen if that's shorter."""
+        out = []
+        changed_rows = 0
+        for y in xrange(screen.rows):
+            chars, attrs = screen.chars[y], screen.attrs[y]
+            shown_chars, shown_attrs = self.chars[y], self.attrs[y]
+            if chars == shown_chars and attrs == shown_attrs:
+                continue
+            changed_rows += 1
+            start = last = None
+            for x in xrange(screen.cols):
+                if chars[x] != shown_chars[x] or attrs[x] != shown_attrs[x]:
+                    if start is None:
+                        start = x
+                    elif x - last > _GAP:
+                        out.append(screen._render_cells(y, start, last + 1, False))
+                        start = x
+                    last = x
+            out.append(screen._render_cells(y, start, last + 1, False))
+            self.chars[y] = list(chars)
+            self.attrs[y] = list(attrs)
+        attr = self.attr
+        if out:
+            #cells are drawn starting from and ending with the default attributes
+            if attr:
+                out.insert(0, '\x1b[0m')
+            attr = ''
+        region = (screen.top, screen.bottom)
+        if region != self.region:
+            #this also moves the cursor home
+            out.append('\x1b[%s;%sr' % (region[0] + 1, region[1] + 1))
+        cursor = (screen.x, screen.y)
+        if out or cursor != self.cursor:
+            out.append('\x1b[%s;%sH' % (screen.y + 1, screen.x + 1))
+        if screen.attr != attr:
+            out.append('\x1b[0;%sm' % screen.attr if screen.attr else '\x1b[0m')
+        data = ''.join(out)
+        if changed_rows > screen.rows // 2:
+            full = self._full(screen)
+            if len(full) < len(data):
+                data = full
+        self.region = region
+        self.cursor = cursor
+        self.attr = screen.attr
+        return data
+
+KEYFRAMES_SUFFIX = '.keyframes'
+"Suffix appended to the recording path for storing its keyframes."
+
+_KEYFRAMES_VERSION = 1
+
+def _entries_from(tty_file, offset, first_time):
+    """Yields (byte offset, seconds from the beginning, payload) of the entries starting at offset.
+
+:param first_time: seconds from the beginning of the recording of the entry at offset."""
+    with Stream(tty_file, 'rb') as fin:
+        fin.seek(offset)
+        base = None
+        try:
+            for entry_offset, sec, usec, payload in iter_records(fin):
+                tstamp = sec + usec / 1000000.0
+                if base is None:
+                    base = tstamp - first_time
+                yield entry_offset, tstamp - base, payload
+        except TruncatedEntryError as e:
+            #probably still being recorded
+            log.debug('%s: %s', tty_file, e)
+
+class Keyframes(Sidecar):
+    """Snapshots of the screen taken every interval seconds along a ttyrec file."""
+    SUFFIX = KEYFRAMES_SUFFIX
+    KIND = 'keyframes'
+
+    def __init__(self, rows=24, cols=80, interval=10.0, size=None, mtime=None):
+        self.rows = rows
+        self.cols = cols
+        self.interval = interval
+        self.size = size
+        self.mtime = mtime
+        self.frames = []
+        "list of (entry number, seconds from the beginning, byte offset, snapshot before the entry)"
+        self._times = None
+
+    @staticmethod
+    def build(tty_file, rows=24, cols=80, interval=10.0):
+        """Replays the whole file once taking a snapshot every interval seconds.
+
+:returns: the :class:`Keyframes` of the file."""
+        tty_file = expand_path(tty_file)
+        stat = os.stat(tty_file)
+        keyframes = Keyframes(rows, cols, interval, stat.st_size, stat.st_mtime)
+        screen = Screen(rows, cols)
+        next_time = 0.0
+        last_time = None
+        for nr, (offset, tstamp, payload) in enumerate(_entries_from(tty_file, 0, 0.0)):
+            #only where the time changes, so seeking to that time starts at this entry
+            if tstamp >= next_time and tstamp != last_time:
+                keyframes.frames.append((nr, tstamp, offset, screen.snapshot()))
+                next_time = tstamp + interval
+            screen.feed(payload)
+            last_time = tstamp
+        return keyframes
+
+    def dump(self, fout):
+        """Writes the keyframes to the given binary stream (see :meth:`save`)."""
+        marshal.dump((_KEYFRAMES_VERSION, self.rows, self.cols, self.interval, self.size,
+                      self.mtime, self.frames), fout)
+
+    @staticmethod
+    def load(keyframes_file):
+        """:returns: the stored :class:`Keyframes`."""
+        with open(keyframes_file, 'rb') as fin:
+            try:
+                data = marshal.load(fin)
+            except (EOFError, ValueError, TypeError):
+                raise TTYrecError('Keyframes %s are corrupted' % keyframes_file)
+        if not isinstance(data, tuple) or len(data) != 7 or data[0] != _KEYFRAMES_VERSION:
+            raise TTYrecError('Keyframes %s have an unknown format' % keyframes_file)
+        keyframes = Keyframes(*data[1:6])
+        keyframes.frames = data[6]
+        return keyframes
+
+    @classmethod
+    def for_file(cls, tty_file, rows=24, cols=80, interval=10.0, save=True):
+        """Returns the keyframes of the given file, building them if they don't exist or were
+built for another file or settings (see :meth:`ttyrec.io.Sidecar.for_file`)."""
+        return super(Keyframes, cls).for_file(tty_file, save, rows=rows, cols=cols, interval=interval)
+
+    def keyframe_before(self, tstamp):
+        """:returns: the last keyframe taken at or before tstamp seconds."""
+        if self._times is None or len(self._times) != len(self.frames):
+            self._times = [frame[1] for frame in self.frames]
+        return self.frames[max(0, bisect_right(self._times, tstamp) - 1)]
+
+    def seek(self, tty_file, tstamp):
+        """Rebuilds the screen at the given time restoring the closest keyframe and replaying
+only the entries after it.
+
+:returns: the :class:`Screen` at tstamp and a generator of the remaining entries
+    (:class:`ttyrec.io.TTYrecEntry`, the first duration is relative to tstamp)."""
+        screen = Screen(self.rows, self.cols)
+        if not self.frames:
+            return screen, iter(())
+        _, ktime, offset, snapshot = self.keyframe_before(tstamp)
+        screen.restore(snapshot)
+        entries = _entries_from(tty_file, offset, ktime)
+        for _, entry_time, payload in entries:
+            if entry_time > tstamp:
+                break
+            screen.feed(payload)
+        else:
+            return screen, iter(())
+        def gen():
+            yield TTYrecEntry(entry_time - tstamp, payload)
+            last = entry_time
+            for _, next_time, next_payload in entries:
+                yield TTYrecEntry(next_time - last, next_payload)
+                last = next_time
+        return screen, gen()
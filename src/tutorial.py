@@ -7,9 +7,8 @@ import os
 import logging
 log = logging.getLogger(__name__)
 
-from glob import glob
 from evaluation_system.api import plugin
-from ttyrec.io import Player
+from ttyrec.io import Player, find_recordings
 
 class Tutorials(plugin.PluginAbstract):
     __short_description__ = "Display some tutorials." 
@@ -20,12 +19,12 @@ class Tutorials(plugin.PluginAbstract):
     def getHelp(self):
         path_to_this_file = self.getClassBaseDir()
         return '%s\nList of available tutorials:\n\t%s' % (super(Tutorials,self).getHelp(),
-            '\n\t'.join(os.listdir('%s/recordings' % path_to_this_file)))
+            '\n\t'.join(os.path.basename(path) for path in find_recordings(['%s/recordings/*' % path_to_this_file])))
         
     def runTool(self, config_dict=None):
         path_to_this_file = self.getClassBaseDir()
         tutorial = config_dict['tutorial']
-        tut_path = glob('%s/recordings/%s' % (path_to_this_file, tutorial))
+        tut_path = find_recordings(['%s/recordings/%s' % (path_to_this_file, tutorial)])
         if len(tut_path) >1:
             raise Exception("Your input resulted in multiple tutorials: %s\nPlease select one" % ', '.join(tut_path))
         elif len(tut_path) == 1: